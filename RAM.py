@@ -1,13 +1,27 @@
 import math
-from nmigen import Elaboratable, Module, Memory, Signal
-from nmigen_soc.wishbone import Interface
+from nmigen import Elaboratable, Module, Memory, Signal, Cat
+from nmigen_soc.wishbone import Interface, CycleType, BurstTypeExt
+from nmigen.sim import Passive
 from nmigen.back import verilog
 
 
+# latency is the number of cycles from a request to its ack.
+#
+# Classic mode: one access at a time, acked latency cycles after stb. The next
+# beat of a linear incrementing burst (cti = INCR_BURST) is read ahead, so it
+# is acked on the following cycle.
+#
+# Pipelined mode (Wishbone B4): stall is never asserted, so a request can be
+# issued every cycle. Acks come back in order, latency cycles later.
 class RAM(Elaboratable, Interface):
-    def __init__(self, addr_width, data_width, data=None):
+    def __init__(self, addr_width, data_width, data=None, pipelined=False, latency=1):
+        if latency < 1:
+            raise ValueError("latency={} must be at least 1".format(latency))
+
         self.addr_width = addr_width
         self.data_width = data_width
+        self.pipelined = pipelined
+        self.latency = latency
 
         if data is not None:
             self.data = data
@@ -15,7 +29,7 @@ class RAM(Elaboratable, Interface):
         else:
             self.data=[0]
 
-        super().__init__(data_width=data_width, addr_width=addr_width, granularity=8)
+        super().__init__(data_width=data_width, addr_width=addr_width, granularity=8, features=["stall", "err", "cti", "bte"])
 
     def elaborate(self, platform):
         m = Module()
@@ -42,21 +56,121 @@ class RAM(Elaboratable, Interface):
 
         m.d.comb += [
             write_port.data.eq(self.dat_w),
-            self.dat_r.eq(read_port.data),
+            write_port.addr.eq(self.adr),
         ]
 
-        m.d.comb += [
-            read_port.addr.eq(self.adr),
-            write_port.addr.eq(self.adr),
+        if self.pipelined:
+            m.d.comb += [
+                self.stall.eq(0),
+                read_port.addr.eq(self.adr),
+            ]
 
-        ]
+            # One bit per cycle of latency, shifted along as requests age
+            acks = Signal(self.latency)
+            with m.If(self.cyc):
+                m.d.sync += acks.eq(Cat(self.stb, acks))
+            with m.Else():
+                m.d.sync += acks.eq(0)
+
+            m.d.comb += self.ack.eq(acks[-1] & self.cyc)
+
+            # Read data comes out of the memory a cycle after the request,
+            # delay it to line up with the ack
+            dat_r = read_port.data
+            for i in range(self.latency - 1):
+                delayed = Signal(self.data_width, name="dat_r_{}".format(i))
+                m.d.sync += delayed.eq(dat_r)
+                dat_r = delayed
 
-        # Ack cycle after cyc and stb are asserted
-        m.d.sync += self.ack.eq(self.cyc & self.stb)
+            m.d.comb += self.dat_r.eq(dat_r)
+
+        else:
+            # Disable wishbone pipelining
+            m.d.comb += self.stall.eq(~self.ack)
+
+            burst = Signal()
+            m.d.comb += burst.eq((self.cti == CycleType.INCR_BURST) & (self.bte == BurstTypeExt.LINEAR))
+
+            # While acking a burst beat, read the next address ahead
+            m.d.comb += [
+                read_port.addr.eq(self.adr + (self.ack & burst)),
+                self.dat_r.eq(read_port.data),
+            ]
+
+            wait = Signal(range(self.latency))
+
+            m.d.sync += self.ack.eq(0)
+            with m.If(self.cyc & self.stb):
+                with m.If(self.ack & burst):
+                    m.d.sync += self.ack.eq(1)
+                with m.Elif(~self.ack):
+                    with m.If(wait == self.latency - 1):
+                        m.d.sync += [
+                            self.ack.eq(1),
+                            wait.eq(0),
+                        ]
+                    with m.Else():
+                        m.d.sync += wait.eq(wait + 1)
+            with m.Else():
+                m.d.sync += wait.eq(0)
 
         return m
 
 
+# Simulation only memory. Contents live in a dict and are filled in from
+# init(adr) the first time a word is touched, so addr_width can be as large as
+# the bus allows. Add process() to the simulator with add_sync_process(). If
+# the memory sits in a gated clock domain, pass the clock enable as enable.
+class SparseRAM(Interface):
+    def __init__(self, addr_width, data_width, init=None, wait_states=0, enable=None):
+        self.addr_width = addr_width
+        self.data_width = data_width
+        self.init = init
+        self.wait_states = wait_states
+        self.enable = enable
+
+        self.data = dict()
+
+        super().__init__(data_width=data_width, addr_width=addr_width, granularity=8, features=["err"])
+
+    def read(self, adr):
+        if adr not in self.data:
+            self.data[adr] = self.init(adr) & (2**self.data_width - 1) if self.init is not None else 0
+        return self.data[adr]
+
+    def write(self, adr, data, sel):
+        mask = 0
+        for i in range(self.data_width//8):
+            if sel & (1 << i):
+                mask |= 0xff << (i*8)
+        self.data[adr] = (self.read(adr) & ~mask) | (data & mask)
+
+    def process(self):
+        yield Passive()
+
+        waited = 0
+        while True:
+            yield
+
+            if self.enable is not None and not (yield self.enable):
+                continue
+
+            if (yield self.cyc) and (yield self.stb) and not (yield self.ack):
+                if waited < self.wait_states:
+                    waited += 1
+                    continue
+
+                adr = (yield self.adr)
+                if (yield self.we):
+                    self.write(adr, (yield self.dat_w), (yield self.sel))
+
+                yield self.dat_r.eq(self.read(adr))
+                yield self.ack.eq(1)
+                waited = 0
+            else:
+                yield self.ack.eq(0)
+
+
 if __name__ == "__main__":
     top = RAM(addr_width=8, data_width=64)
     with open("RAM.v", "w") as f:
@@ -0,0 +1,278 @@
+# Throughput and latency benchmarks for the bridge
+#
+# Every configuration in the sweep is built as a System and driven with the
+# Helpers Wishbone accesses, one at a time, the way a simple master would. The
+# results are written as CSV or JSON and can be compared against a stored
+# baseline so protocol changes can be judged on cycles rather than feel.
+#
+# MB/s per MHz is the payload (selected bytes) moved per clock cycle. Bytes
+# per word is the link bytes spent on the data of each write and read, which
+# zero suppression (compress) brings down for small values.
+#
+# stream, packed and post_depth select the Host framing and posted writes in
+# the Peripheral, a post_depth of 0 means writes are not posted.
+#
+# Long sweeps can run on a compiled engine with SIMBUS_SIM_BACKEND=cxxsim,
+# see helpers.simulator().
+
+import argparse
+import csv
+import itertools
+import json
+import random
+import sys
+
+from helpers import Helpers, simulator
+from model import _encode
+from test_system import System
+
+
+# registers is full word accesses of the small values typical of device
+# registers: zero, flags, counters and pointers. fifo is full word accesses
+# that all go to one address, like a device FIFO register.
+PATTERNS = ["sequential", "random", "partial", "registers", "fifo"]
+
+FIELDS = ["addr_width", "data_width", "bus_width", "divisor", "pattern", "compress", "stream", "packed", "post_depth",
+          "accesses", "cycles_per_write", "cycles_per_read", "mb_per_s_per_mhz", "bytes_per_word"]
+
+KEY_FIELDS = FIELDS[:9]
+
+# Key fields missing from older baselines, and their value then
+KEY_DEFAULTS = dict(compress=False, stream=False, packed=False, post_depth=0)
+
+
+class Benchmark(Helpers):
+    # Word address width of the RAM behind the Peripheral
+    mem_addr_width = 8
+
+    def __init__(self, addr_width=32, data_width=64, bus_width=8, divisor=1, pattern="sequential", compress=False,
+                 stream=False, packed=False, post_depth=0, accesses=64, seed=0):
+        if pattern not in PATTERNS:
+            raise ValueError("pattern={} is not one of {}".format(pattern, ", ".join(PATTERNS)))
+
+        self.addr_width = addr_width
+        self.data_width = data_width
+        self.bus_width = bus_width
+        self.divisor = divisor
+        self.pattern = pattern
+        self.compress = compress
+        self.stream = stream
+        self.packed = packed
+        self.post_depth = post_depth
+        self.accesses = accesses
+        self.seed = seed
+
+    def traffic(self):
+        rng = random.Random(self.seed)
+        full_sel = 2**(self.data_width//8) - 1
+
+        for i in range(self.accesses):
+            if self.pattern == "sequential":
+                adr = i % 2**self.mem_addr_width
+            elif self.pattern == "fifo":
+                adr = 0x10
+            else:
+                adr = rng.randrange(2**self.mem_addr_width)
+
+            if self.pattern == "partial":
+                sel = rng.randrange(1, full_sel)
+            else:
+                sel = full_sel
+
+            if self.pattern == "registers":
+                data = rng.choice([
+                    0,
+                    1 << rng.randrange(self.data_width),
+                    rng.getrandbits(16),
+                    rng.getrandbits(32) & ~3,
+                ])
+            else:
+                data = rng.getrandbits(self.data_width)
+
+            yield (adr, sel, data)
+
+    # Link beats carrying a word of data
+    def data_beats(self, data):
+        data_cycles = self.data_width//self.bus_width
+        if self.compress:
+            return len(_encode(data, data_cycles, self.bus_width)[1])
+        return data_cycles
+
+    def run(self):
+        dut = System(addr_width=self.mem_addr_width, data_width=self.data_width, bus_width=self.bus_width,
+                     divisor=self.divisor, link_addr_width=self.addr_width, compress=self.compress, stream=self.stream,
+                     packed=self.packed, post_writes=self.post_depth > 0, post_depth=max(self.post_depth, 1))
+
+        traffic = list(self.traffic())
+        totals = dict(write=0, read=0, payload=0, beats=0)
+
+        def bench():
+            expected = dict()
+            for (adr, sel, data) in traffic:
+                (_, cycles) = (yield from self.timed(self.wishbone_write(dut.wb, adr, data, sel)))
+                totals["write"] += cycles
+                totals["beats"] += self.data_beats(data)
+
+                mask = 0
+                for i in range(self.data_width//8):
+                    if sel & (1 << i):
+                        mask |= 0xff << (i*8)
+                        totals["payload"] += 1
+                expected[adr] = (adr, mask, data & mask)
+
+            for (adr, sel, data) in traffic:
+                (got, cycles) = (yield from self.timed(self.wishbone_read(dut.wb, adr, sel)))
+                totals["read"] += cycles
+                totals["beats"] += self.data_beats(got)
+                totals["payload"] += bin(sel).count("1")
+
+                (_, mask, data) = expected[adr]
+                if got & mask != data:
+                    raise AssertionError("Read {:#x} from {:#x}, expected {:#x}".format(got & mask, adr, data))
+
+        sim = simulator(dut)
+        sim.add_clock(1e-6)  # 1 MHz
+        sim.add_sync_process(bench)
+        sim.run()
+
+        return {
+            "addr_width": self.addr_width,
+            "data_width": self.data_width,
+            "bus_width": self.bus_width,
+            "divisor": self.divisor,
+            "pattern": self.pattern,
+            "compress": self.compress,
+            "stream": self.stream,
+            "packed": self.packed,
+            "post_depth": self.post_depth,
+            "accesses": self.accesses,
+            "cycles_per_write": totals["write"] / self.accesses,
+            "cycles_per_read": totals["read"] / self.accesses,
+            "mb_per_s_per_mhz": totals["payload"] / (totals["write"] + totals["read"]),
+            "bytes_per_word": totals["beats"] * self.bus_width / 8 / (2*self.accesses),
+        }
+
+
+def sweep(addr_widths, data_widths, bus_widths, divisors, patterns, compress, stream, packed, post_depths, accesses, seed):
+    for (addr_width, data_width, bus_width, divisor, pattern, c, s, p, post_depth) in itertools.product(
+            addr_widths, data_widths, bus_widths, divisors, patterns, compress, stream, packed, post_depths):
+        if addr_width % bus_width or data_width % bus_width:
+            continue
+
+        # sel is sent in a single beat
+        if data_width//8 > bus_width:
+            continue
+
+        # Packed headers make stream redundant
+        if s and p:
+            continue
+
+        if p and addr_width//bus_width > 7:
+            continue
+
+        yield Benchmark(addr_width=addr_width, data_width=data_width, bus_width=bus_width, divisor=divisor,
+                        pattern=pattern, compress=c, stream=s, packed=p, post_depth=post_depth,
+                        accesses=accesses, seed=seed).run()
+
+
+def write_results(results, f, fmt):
+    if fmt == "json":
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    else:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def read_results(filename):
+    with open(filename) as f:
+        if filename.endswith(".json"):
+            return json.load(f)
+
+        results = list(csv.DictReader(f))
+        for r in results:
+            for field in FIELDS:
+                if field not in r:
+                    continue
+                if field in ("compress", "stream", "packed"):
+                    r[field] = r[field] == "True"
+                elif field != "pattern":
+                    r[field] = float(r[field]) if "." in r[field] else int(r[field])
+        return results
+
+
+# Returns the number of configurations that got worse by more than tolerance
+def compare(results, baseline, tolerance, f=sys.stdout):
+    old = dict()
+    for r in baseline:
+        for (k, v) in KEY_DEFAULTS.items():
+            r.setdefault(k, v)
+        old[tuple(r[k] for k in KEY_FIELDS)] = r
+
+    regressions = 0
+    for r in results:
+        key = tuple(r[k] for k in KEY_FIELDS)
+        if key not in old:
+            continue
+
+        changes = []
+        worse = False
+        for field in ["cycles_per_write", "cycles_per_read", "mb_per_s_per_mhz", "bytes_per_word"]:
+            if field not in old[key]:
+                continue
+
+            before = old[key][field]
+            after = r[field]
+            if before == after:
+                continue
+
+            delta = (after - before) / before
+            changes.append("{} {:.3f} -> {:.3f} ({:+.1%})".format(field, before, after, delta))
+
+            # Fewer cycles and bytes and more bandwidth are better
+            if field == "mb_per_s_per_mhz":
+                delta = -delta
+            if delta > tolerance:
+                worse = True
+
+        if changes:
+            f.write("{}: {}{}\n".format("/".join(str(k) for k in key), ", ".join(changes), " REGRESSION" if worse else ""))
+        if worse:
+            regressions += 1
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure bridge throughput and latency across bus parameters")
+    parser.add_argument("--addr-width", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--data-width", type=int, nargs="+", default=[32, 64])
+    parser.add_argument("--bus-width", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--divisor", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--pattern", choices=PATTERNS, nargs="+", default=PATTERNS)
+    parser.add_argument("--compress", type=int, choices=[0, 1], nargs="+", default=[0, 1], help="zero suppression off (0) and/or on (1)")
+    parser.add_argument("--stream", type=int, choices=[0, 1], nargs="+", default=[0, 1], help="stream frames off (0) and/or on (1)")
+    parser.add_argument("--packed", type=int, choices=[0, 1], nargs="+", default=[0, 1], help="packed headers off (0) and/or on (1)")
+    parser.add_argument("--post-depth", type=int, nargs="+", default=[0, 4], help="posted write queue depths, 0 for none")
+    parser.add_argument("--accesses", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--baseline", help="compare against results from a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="allowed relative regression (default 0.01)")
+    args = parser.parse_args()
+
+    results = list(sweep(args.addr_width, args.data_width, args.bus_width, args.divisor, args.pattern,
+                         [bool(c) for c in args.compress], [bool(s) for s in args.stream], [bool(p) for p in args.packed],
+                         args.post_depth, args.accesses, args.seed))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            write_results(results, f, args.format)
+    else:
+        write_results(results, sys.stdout, args.format)
+
+    if args.baseline:
+        if compare(results, read_results(args.baseline), args.tolerance, sys.stderr):
+            sys.exit(1)
@@ -4,5 +4,42 @@ from enum import IntEnum, unique
 class CmdEnum(IntEnum):
     READ = 0x2
     WRITE = 0x3
+    # Same address as the previous access of the same kind, see Host
+    READ_STREAM = 0x4
+    WRITE_STREAM = 0x5
+    # Link calibration, the Peripheral sends the next beat back
+    ECHO = 0x8
     READ_ACK = 0x82
     WRITE_ACK = 0x83
+    ECHO_ACK = 0x88
+    # Zero suppressed data: a mask with one bit per data beat, then only the
+    # beats that are non zero
+    WRITE_Z = 0x13
+    WRITE_STREAM_Z = 0x15
+    READ_ACK_Z = 0x92
+
+
+# Set on a READ_ACK, READ_ACK_Z or WRITE_ACK when a posted write has failed
+# since the last ack that reported one, see Peripheral
+ACK_ERROR = 0x20
+
+
+# Packed (v1) command header, see Host. Bits 5:3 are the number of address
+# beats that follow. HEADER_Z is only valid for writes, the Peripheral ignores
+# a read header with it set.
+HEADER_V1 = 0x80
+HEADER_WE = 0x40
+HEADER_ADDR_SHIFT = 3
+HEADER_INCR = 0x04
+HEADER_Z = 0x02
+HEADER_FULL = 0x01
+
+# Bits above the first byte of a packed header, on a link wider than 8 bits
+HEADER_WIDE_SHIFT = 8
+
+
+# Widths of the size and byte lane fields that replace the sel beat in a wide
+# packed header, for a data_width bit word
+def header_sel_fields(data_width):
+    lane_bits = (data_width//8 - 1).bit_length()
+    return (lane_bits.bit_length(), lane_bits)
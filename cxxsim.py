@@ -0,0 +1,426 @@
+# Compiled simulation engine
+#
+# CxxSimEngine runs a design through CXXRTL. The fragment is converted to
+# RTLIL, yosys writes it out as C++ and that is built into a shared library,
+# which is cached in .cxxsim_cache (or SIMBUS_CXXSIM_CACHE) under a hash of
+# the generated code, so only the first run of a design pays for the compile.
+# It plugs into the Simulator as an engine class, so testbenches keep using
+# add_clock(), add_sync_process() and the Helpers generators unchanged.
+# helpers.simulator() selects it with SIMBUS_SIM_BACKEND=cxxsim.
+#
+# yosys comes from the amaranth-yosys package (pip install amaranth-yosys) or
+# the system, and needs write_cxxrtl with the C API. CXX picks the compiler.
+#
+# Scheduling follows pysim: processes woken by a clock edge read the values
+# from before the edge and their writes land after it, and Settle waits until
+# the design has settled. Only clocks added with add_clock() can be waited on.
+
+import ctypes
+import hashlib
+import os
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+from amaranth.hdl.ast import Signal, Const, Value, Statement, Assign, SignalDict
+from amaranth.back import rtlil
+from amaranth.sim import Tick, Settle, Delay, Passive, Active
+from amaranth.sim._base import BaseEngine
+from amaranth.sim._pyrtl import _ValueCompiler, _RHSValueCompiler, _StatementCompiler
+from amaranth._toolchain.yosys import find_yosys
+
+
+CACHE_DIR = os.environ.get("SIMBUS_CXXSIM_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cxxsim_cache"))
+CXXFLAGS = ["-std=c++14", "-O2", "-shared", "-fPIC", "-DCXXRTL_INCLUDE_CAPI_IMPL", "-DCXXRTL_INCLUDE_VCD_CAPI_IMPL"]
+
+# cxxrtl_type and cxxrtl_flag from cxxrtl_capi.h
+CXXRTL_OUTLINE = 4
+CXXRTL_INPUT = 1 << 0
+
+
+class _Object(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        ("width", ctypes.c_size_t),
+        ("lsb_at", ctypes.c_size_t),
+        ("depth", ctypes.c_size_t),
+        ("zero_at", ctypes.c_size_t),
+        ("curr", ctypes.c_void_p),
+        ("next", ctypes.c_void_p),
+        ("outline", ctypes.c_void_p),
+        ("attrs", ctypes.c_void_p),
+    ]
+
+
+def _load(path):
+    lib = ctypes.CDLL(path)
+
+    lib.cxxrtl_design_create.restype = ctypes.c_void_p
+    lib.cxxrtl_create.argtypes = [ctypes.c_void_p]
+    lib.cxxrtl_create.restype = ctypes.c_void_p
+    lib.cxxrtl_destroy.argtypes = [ctypes.c_void_p]
+    lib.cxxrtl_step.argtypes = [ctypes.c_void_p]
+    lib.cxxrtl_step.restype = ctypes.c_size_t
+    lib.cxxrtl_get_parts.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t)]
+    lib.cxxrtl_get_parts.restype = ctypes.POINTER(_Object)
+    lib.cxxrtl_outline_eval.argtypes = [ctypes.c_void_p]
+
+    lib.cxxrtl_vcd_create.restype = ctypes.c_void_p
+    lib.cxxrtl_vcd_destroy.argtypes = [ctypes.c_void_p]
+    lib.cxxrtl_vcd_timescale.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p]
+    lib.cxxrtl_vcd_add_from_without_memories.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.cxxrtl_vcd_sample.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
+    lib.cxxrtl_vcd_read.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_size_t)]
+
+    return lib
+
+
+# The shared library for an RTLIL design, built if it is not in the cache
+def build(rtlil_text):
+    try:
+        yosys = find_yosys(lambda ver: ver >= (0, 40))
+    except Exception as e:
+        raise RuntimeError("cxxsim needs yosys 0.40 or later, e.g. pip install amaranth-yosys: {}".format(e))
+
+    cxx = os.environ.get("CXX", "c++")
+    # Keep named signals as wires. Outlines that are computed on demand miss
+    # asynchronous memory reads, such as the head of a SyncFIFO.
+    source = yosys.run(["-q", "-"], "read_rtlil <<rtlil\n{}\nrtlil\nwrite_cxxrtl -O4".format(rtlil_text))
+
+    key = hashlib.sha256("\n".join([cxx, " ".join(CXXFLAGS), source]).encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, key + ".so")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    include = os.path.join(yosys.data_dir(), "include", "backends", "cxxrtl", "runtime")
+    with tempfile.TemporaryDirectory(dir=CACHE_DIR) as build_dir:
+        cc = os.path.join(build_dir, "design.cc")
+        with open(cc, "w") as f:
+            f.write(source)
+
+        so = os.path.join(build_dir, "design.so")
+        subprocess.run([cxx, *CXXFLAGS, "-I", include, cc, "-o", so], check=True)
+        # Parallel test workers may build the same design
+        os.replace(so, path)
+
+    return path
+
+
+class _SignalState:
+    __slots__ = ("signal", "engine", "parts", "value", "writable")
+
+    def __init__(self, signal, engine, parts):
+        self.signal = signal
+        self.engine = engine
+        # (object, words) for each part of the signal found in the design. A
+        # signal the design does not use is held here in value instead.
+        self.parts = parts
+        self.value = signal.reset
+        self.writable = not parts or all(obj.next for (obj, _) in parts)
+
+    @property
+    def curr(self):
+        if not self.parts:
+            return self.value
+
+        value = 0
+        for (obj, words) in self.parts:
+            if obj.type == CXXRTL_OUTLINE:
+                self.engine.lib.cxxrtl_outline_eval(obj.outline)
+            bits = 0
+            for (i, word) in enumerate((ctypes.c_uint32 * words).from_address(obj.curr)):
+                bits |= word << (32*i)
+            value |= bits << obj.lsb_at
+
+        if self.signal.signed and value >> (self.signal.width - 1):
+            value -= 1 << self.signal.width
+        return value
+
+    @property
+    def next(self):
+        return self.engine.pending.get(self, self.curr)
+
+    def set(self, value):
+        if not self.writable:
+            raise ValueError("Signal {!r} is driven by the design and cannot be written by a testbench".format(self.signal))
+        self.engine.pending[self] = value
+
+    def commit(self, value):
+        if not self.parts:
+            self.value = value
+            return
+
+        value &= (1 << self.signal.width) - 1
+        for (obj, words) in self.parts:
+            bits = (value >> obj.lsb_at) & ((1 << obj.width) - 1)
+            array = (ctypes.c_uint32 * words).from_address(obj.next)
+            for i in range(words):
+                array[i] = (bits >> (32*i)) & 0xffffffff
+
+
+class _Process:
+    def __init__(self, engine, constructor, default_cmd):
+        self.engine = engine
+        self.constructor = constructor
+        self.default_cmd = default_cmd
+        self.reset()
+
+    def reset(self):
+        self.coroutine = self.constructor()
+        self.passive = False
+        self.exec_locals = {"slots": self.engine.slots, "result": None, **_ValueCompiler.helpers}
+
+    # Runs until the process waits, returning what it waits for: a clock,
+    # Settle, a deadline in ps, or None once it has finished
+    def run(self):
+        engine = self.engine
+        response = None
+
+        while True:
+            try:
+                command = self.coroutine.send(response)
+                if command is None:
+                    command = self.default_cmd
+                response = None
+
+                if isinstance(command, Signal):
+                    response = engine.slots[engine.get_signal(command)].curr
+
+                elif isinstance(command, Value):
+                    exec(_RHSValueCompiler.compile(engine, command, mode="curr"), self.exec_locals)
+                    response = Const.normalize(self.exec_locals["result"], command.shape())
+
+                elif type(command) is Assign and type(command.lhs) is Signal and type(command.rhs) is Const:
+                    engine.slots[engine.get_signal(command.lhs)].set(Const.normalize(command.rhs.value, command.lhs.shape()))
+
+                elif isinstance(command, Statement):
+                    exec(_StatementCompiler.compile(engine, command), self.exec_locals)
+
+                elif type(command) is Tick:
+                    domain = command.domain
+                    if isinstance(domain, str):
+                        domain = engine.fragment.domains[domain]
+                    clock = engine.clocks.get(domain.clk)
+                    if clock is None:
+                        raise NotImplementedError("cxxsim can only wait on clocks added with add_clock(), not {!r}".format(domain.name))
+                    return clock
+
+                elif type(command) is Settle or (type(command) is Delay and command.interval is None):
+                    return Settle
+
+                elif type(command) is Delay:
+                    return engine.now + int(command.interval * 1e12)
+
+                elif type(command) is Passive:
+                    self.passive = True
+
+                elif type(command) is Active:
+                    self.passive = False
+
+                elif command is None:
+                    raise TypeError("Received default command from a process that was added with add_process(); "
+                                    "did you mean to add this process with add_sync_process() instead?")
+
+                else:
+                    raise TypeError("Received unsupported command {!r}".format(command))
+
+            except StopIteration:
+                self.passive = True
+                self.coroutine = None
+                return None
+
+            except Exception as exn:
+                self.coroutine.throw(exn)
+
+
+class _Clock:
+    def __init__(self, slot, phase, period):
+        self.slot = slot
+        self.phase = phase
+        self.period = period
+        self.reset()
+
+    def reset(self):
+        self.deadline = self.phase
+        self.value = 0
+        self.waiters = []
+
+
+class CxxSimEngine(BaseEngine):
+    def __init__(self, fragment):
+        self.fragment = fragment
+
+        (rtlil_text, self._names) = rtlil.convert_fragment(fragment, name="top")
+        self.lib = _load(build(rtlil_text))
+        self._handle = None
+
+        self.signals = SignalDict()
+        self.slots = []
+        self.pending = dict()
+        self.clocks = SignalDict()
+        # The same, in the order they were added
+        self._clocks = []
+        self._processes = []
+        self._vcds = []
+
+        self.reset()
+
+    def reset(self):
+        if self._handle is not None:
+            self.lib.cxxrtl_destroy(self._handle)
+        self._handle = self.lib.cxxrtl_create(self.lib.cxxrtl_design_create())
+
+        self.signals.clear()
+        self.slots.clear()
+        self.pending.clear()
+
+        self._now = 0
+        self._waiting = dict()
+        self._runnable = list(self._processes)
+        for process in self._processes:
+            process.reset()
+        for clock in self._clocks:
+            clock.reset()
+
+        # Inputs start at their reset values, then everything settles
+        for signal in self._names:
+            state = self.slots[self.get_signal(signal)]
+            if state.parts and all(obj.flags & CXXRTL_INPUT for (obj, _) in state.parts) and signal.reset:
+                state.commit(signal.reset)
+        self.lib.cxxrtl_step(self._handle)
+
+    @property
+    def now(self):
+        return self._now
+
+    def get_signal(self, signal):
+        try:
+            return self.signals[signal]
+        except KeyError:
+            pass
+
+        parts = []
+        name = self._names.get(signal)
+        if name is not None:
+            count = ctypes.c_size_t()
+            objects = self.lib.cxxrtl_get_parts(self._handle, " ".join(name[1:]).encode(), ctypes.byref(count))
+            if objects:
+                parts = [(objects[i], (objects[i].width + 31)//32) for i in range(count.value)]
+
+        index = len(self.slots)
+        self.slots.append(_SignalState(signal, self, parts))
+        self.signals[signal] = index
+        return index
+
+    def add_coroutine_process(self, process, *, default_cmd):
+        process = _Process(self, process, default_cmd)
+        self._processes.append(process)
+        self._runnable.append(process)
+
+    def add_clock_process(self, clock, *, phase, period):
+        self.clocks[clock] = _Clock(self.get_signal(clock), phase, period)
+        self._clocks.append(self.clocks[clock])
+
+    # Runs processes, keeping the clocks they wait on, and applies their writes
+    def _run(self, processes):
+        settle = []
+        for process in processes:
+            wait = process.run()
+            if wait is None:
+                continue
+            elif wait is Settle:
+                settle.append(process)
+            elif isinstance(wait, _Clock):
+                wait.waiters.append(process)
+            else:
+                self._waiting[process] = wait
+        return settle
+
+    def _commit(self):
+        if self.pending:
+            for (state, value) in self.pending.items():
+                state.commit(value)
+            self.pending.clear()
+            self.lib.cxxrtl_step(self._handle)
+
+    def advance(self):
+        now = self._now
+
+        # Processes starting or at the end of a Delay, before any clock edge
+        runnable = self._runnable + [p for (p, deadline) in self._waiting.items() if deadline == now]
+        for process in runnable[len(self._runnable):]:
+            del self._waiting[process]
+        self._runnable = []
+        settle = self._run(runnable)
+        self._commit()
+
+        for clock in self._clocks:
+            if clock.deadline != now:
+                continue
+
+            clock.value ^= 1
+            clock.deadline += clock.period//2
+
+            woken = []
+            if clock.value:
+                (woken, clock.waiters) = (clock.waiters, [])
+
+            # Woken processes see the design as it was before the edge
+            settle += self._run(woken)
+            edge = self.pending
+            self.pending = dict()
+            self.slots[clock.slot].commit(clock.value)
+            self.lib.cxxrtl_step(self._handle)
+            self.pending = edge
+            self._commit()
+
+        while settle:
+            settle = self._run(settle)
+            self._commit()
+
+        for vcd in self._vcds:
+            vcd.sample(now)
+
+        deadlines = [clock.deadline for clock in self._clocks] + list(self._waiting.values())
+        if deadlines:
+            self._now = min(deadlines)
+
+        return any(not process.passive for process in self._processes)
+
+    @contextmanager
+    def write_vcd(self, *, vcd_file, gtkw_file, traces):
+        if gtkw_file is not None:
+            raise NotImplementedError("cxxsim does not write GTKWave save files")
+
+        vcd = _VCDWriter(self, vcd_file)
+        try:
+            self._vcds.append(vcd)
+            yield
+        finally:
+            self._vcds.remove(vcd)
+            vcd.close()
+
+
+class _VCDWriter:
+    def __init__(self, engine, vcd_file):
+        self.lib = engine.lib
+        self.file = open(vcd_file, "wb") if isinstance(vcd_file, str) else vcd_file
+
+        self.vcd = self.lib.cxxrtl_vcd_create()
+        self.lib.cxxrtl_vcd_timescale(self.vcd, 1, b"ps")
+        self.lib.cxxrtl_vcd_add_from_without_memories(self.vcd, engine._handle)
+        self.sample(engine.now)
+
+    def sample(self, time):
+        self.lib.cxxrtl_vcd_sample(self.vcd, time)
+
+        data = ctypes.c_char_p()
+        size = ctypes.c_size_t()
+        self.lib.cxxrtl_vcd_read(self.vcd, ctypes.byref(data), ctypes.byref(size))
+        self.file.write(ctypes.string_at(data, size.value))
+
+    def close(self):
+        self.lib.cxxrtl_vcd_destroy(self.vcd)
+        self.file.close()
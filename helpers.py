@@ -1,6 +1,67 @@
+import os
+import tempfile
 import unittest
 
-from peripheral import CmdEnum
+from nmigen.sim import Simulator
+from nmigen_soc.wishbone import CycleType
+
+from cmd import CmdEnum, ACK_ERROR
+
+SIM_BACKENDS = ("pysim", "cxxsim")
+VCD_MODES = ("fail", "all", "none")
+
+
+# Testbenches run on the engine named by SIMBUS_SIM_BACKEND, pysim by
+# default. cxxsim compiles the design through CXXRTL (see cxxsim.py).
+def simulator(fragment):
+    backend = os.environ.get("SIMBUS_SIM_BACKEND", "pysim")
+    if backend not in SIM_BACKENDS:
+        raise ValueError("SIMBUS_SIM_BACKEND={} must be one of {}".format(backend, ", ".join(SIM_BACKENDS)))
+
+    if backend == "cxxsim":
+        from cxxsim import CxxSimEngine
+        return Simulator(fragment, engine=CxxSimEngine)
+
+    return Simulator(fragment, engine=backend)
+
+
+# Runs the sync processes against dut on a 1 MHz clock. Waveforms are
+# written to <test id>.vcd (<test id>.<name>.vcd for tests running more than
+# one simulation) as SIMBUS_VCD asks: fail (the default) keeps the waveform
+# of a failing run only, all keeps every run and none never traces.
+def run_simulation(test, dut, *processes, name=None):
+    mode = os.environ.get("SIMBUS_VCD", "fail")
+    if mode not in VCD_MODES:
+        raise ValueError("SIMBUS_VCD={} must be one of {}".format(mode, ", ".join(VCD_MODES)))
+
+    vcd = "{}.vcd".format(test.id() if name is None else "{}.{}".format(test.id(), name))
+
+    sim = simulator(dut)
+    sim.add_clock(1e-6)  # 1 MHz
+    for process in processes:
+        sim.add_sync_process(process)
+
+    if mode == "none":
+        sim.run()
+        return
+
+    if mode == "all":
+        with sim.write_vcd(vcd):
+            sim.run()
+        return
+
+    # Traced to a temporary file next to the final one, which is kept only
+    # if the run fails
+    (fd, trace) = tempfile.mkstemp(suffix=".vcd", dir=os.path.dirname(os.path.abspath(vcd)))
+    os.close(fd)
+    try:
+        with sim.write_vcd(trace):
+            sim.run()
+    except BaseException:
+        os.replace(trace, vcd)
+        raise
+    os.remove(trace)
+
 
 class Helpers:
     def wishbone_write(self, wb, addr, data, sel=1):
@@ -43,41 +104,138 @@ class Helpers:
 
         return (yield wb.dat_r)
 
-    def external_bus_read(self, bus_out, bus_in, addr, addr_width=4, data_width=8, bus_width=8):
+    # Wishbone B4 pipelined accesses, issued back to back as fast as stall
+    # allows. accesses is a list of (addr, data, sel), with data None for a
+    # read. Returns dat_r for each access in order.
+    def wishbone_pipelined(self, wb, accesses):
+        results = []
+        issued = 0
+        outstanding = 0
+
+        def present(i):
+            (addr, data, sel) = accesses[i]
+            yield wb.adr.eq(addr)
+            yield wb.we.eq(data is not None)
+            yield wb.sel.eq(sel)
+            if data is not None:
+                yield wb.dat_w.eq(data)
+            yield wb.stb.eq(1)
+
+        yield wb.cyc.eq(1)
+        yield from present(0)
+
+        while issued < len(accesses) or outstanding:
+            # clock
+            yield
+
+            if (yield wb.stb) and not (yield wb.stall):
+                issued += 1
+                outstanding += 1
+
+            if (yield wb.ack):
+                results.append((yield wb.dat_r))
+                outstanding -= 1
+
+            if issued < len(accesses):
+                yield from present(issued)
+            else:
+                yield wb.stb.eq(0)
+                yield wb.we.eq(0)
+
+        yield wb.cyc.eq(0)
+        yield wb.sel.eq(0)
+
+        return results
+
+    # Wishbone registered feedback linear incrementing burst of length beats.
+    # data is a list of words to write, or None to read. Returns the words read.
+    def wishbone_burst(self, wb, addr, length, data=None, sel=1):
+        results = []
+
+        yield wb.cyc.eq(1)
+        yield wb.stb.eq(1)
+        yield wb.we.eq(data is not None)
+        yield wb.sel.eq(sel)
+
+        for i in range(length):
+            yield wb.adr.eq(addr + i)
+            yield wb.cti.eq(CycleType.END_OF_BURST if i == length-1 else CycleType.INCR_BURST)
+            if data is not None:
+                yield wb.dat_w.eq(data[i])
+
+            # clock
+            yield
+
+            while (yield wb.ack) != 1:
+                yield
+
+            results.append((yield wb.dat_r))
+
+        yield wb.cyc.eq(0)
+        yield wb.stb.eq(0)
+        yield wb.we.eq(0)
+        yield wb.sel.eq(0)
+        yield wb.cti.eq(CycleType.CLASSIC)
+
+        return results
+
+    # Run one of the accesses above and count the clocks it took
+    def timed(self, access):
+        cycles = 0
+        value = None
+        try:
+            while True:
+                command = access.send(value)
+                if command is None:
+                    cycles += 1
+                value = (yield command)
+        except StopIteration as e:
+            return (e.value, cycles)
+
+    def external_bus_read(self, bus_out, bus_in, addr, addr_width=32, data_width=64, bus_width=8):
         yield bus_out.eq(CmdEnum.READ)
 
         yield
 
-        for i in range(addr_width):
+        for i in range(addr_width//bus_width):
             yield bus_out.eq(addr)
             addr = addr >> bus_width
             yield
 
         yield bus_out.eq(0)
 
-        while (yield bus_in) != CmdEnum.CMD_READ_ACK:
+        while ((yield bus_in) & ~ACK_ERROR) != CmdEnum.READ_ACK:
             yield
 
-        for i in range(addr_width):
+        yield
+
+        data = 0
+        for i in range(data_width//bus_width):
             data = data | ((yield bus_in) << (i*bus_width))
             yield
 
         return data
 
-    def external_bus_write(self, bus_out, bus_in, addr, data, addr_width=4, data_width=8, bus_width=8):
+    def external_bus_write(self, bus_out, bus_in, addr, data, sel=1, addr_width=32, data_width=64, bus_width=8):
         yield bus_out.eq(CmdEnum.WRITE)
 
         yield
 
-        for i in range(addr_width):
+        for i in range(addr_width//bus_width):
             yield bus_out.eq(addr)
             addr = addr >> bus_width
             yield
 
-        for i in range(data_width):
+        yield bus_out.eq(sel)
+
+        yield
+
+        for i in range(data_width//bus_width):
             yield bus_out.eq(data)
             data = data >> bus_width
             yield
 
-        while (yield bus_in) != CmdEnum.CMD_WRITE_ACK:
+        yield bus_out.eq(0)
+
+        while ((yield bus_in) & ~ACK_ERROR) != CmdEnum.WRITE_ACK:
             yield
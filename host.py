@@ -1,7 +1,8 @@
 # clock divider needs to be implemented, and use that to drive state machine
 # and also drive clk_out
 #
-# Needs to check parity and recover if possible (eg retry)
+# Needs to check parity and recover if possible (eg retry). Parity is only
+# checked during link calibration.
 #
 # Do we need a timeout and recover?
 #
@@ -21,11 +22,11 @@
 import math
 
 from enum import Enum, unique
-from amaranth import Elaboratable, Module, Signal, Cat
+from amaranth import Elaboratable, Module, Signal, Cat, Mux, Const, Array
 from amaranth_soc.wishbone import Interface as WishboneInterface
 from amaranth.back import verilog
 
-from cmd import CmdEnum
+from cmd import CmdEnum, HEADER_V1, HEADER_WE, HEADER_ADDR_SHIFT, HEADER_INCR, HEADER_Z, HEADER_FULL, header_sel_fields, ACK_ERROR
 
 
 @unique
@@ -48,31 +49,134 @@ class StateEnum(Enum):
 
     WISHBONE_ACK = 10
 
-
+    WRITE_MASK = 11
+    WRITE_ZDATA = 12
+    READ_MASK = 13
+    READ_ZDATA = 14
+
+    CAL_START = 15
+    CAL_CMD = 16
+    CAL_PATTERN = 17
+    CAL_WAIT = 18
+    CAL_CHECK = 19
+    CAL_END = 20
+    CAL_FLUSH = 21
+
+
+# Beats echoed during calibration, each followed by zero beats while the
+# echo comes back. Every bit is set in one of the first two and clear in the
+# others, and both have odd parity so parity_in toggles too. Neither can
+# decode as a write in the Peripheral, even with some bits lost to skew: bit
+# 0 is never sent with bits 1 or 2 (WRITE, WRITE_STREAM...), nor bit 7 with
+# bit 6 (a v1 write). The one with bit 7 set is a v1 read header with
+# HEADER_Z, which the Peripheral ignores.
+def _calibration_patterns(bus_width):
+    ones = 2**bus_width - 1
+    upper = int("01" * bus_width, 2) & ~0xff
+    first = (0xb6 | upper) & ones
+    return [first, first ^ ones, 0]
+
+
+# With stream=True an access to the same address (and for writes the same sel)
+# as the previous access in the same direction is sent as a short
+# READ_STREAM or WRITE_STREAM frame without address or sel beats. The
+# Peripheral reuses the address and sel it already holds, so repeated
+# accesses to a device FIFO register cost little more than the data.
+#
+# With compress=True write data is zero suppressed: a mask with one bit per
+# data beat is sent, followed by just the non zero beats. A word is sent raw
+# when that would take fewer beats. The Peripheral must be built with
+# compress=True as well, and does the same for read data.
+#
+# With packed=True every command starts with a packed (v1) header instead of
+# the original CmdEnum command:
+#
+#   7     1, a v1 header
+#   6     write
+#   5:3   number of address beats that follow
+#   2     address is the previous address plus one word, no address beats
+#   1     zero suppressed data
+#   0     no sel beat, a full word write
+#
+# On a link wider than 8 bits the header also carries the low bits of the
+# word address. A write whose sel is a single run of 1, 2, 4... bytes sends
+# it as a size and byte lane instead of a sel beat, with bit 0 set:
+#
+#   8+     low word address bits, for reads and writes with a sel beat
+#   8+     log2 of the size, the byte lane and then the low word address
+#          bits, for writes without one (see header_sel_fields())
+#
+# Only the low address beats that differ from the previous address in the
+# bits the header does not carry are sent, the Peripheral keeps the rest.
+# That makes stream redundant.
+#
+# Link calibration runs at reset with calibrate=True, or when
+# start_calibration is pulsed. Starting from divisor, each divisor in turn
+# echoes a set of patterns through the Peripheral, checking the data and
+# parity that come back. It stops at the first divisor that fails and settles
+# on the fastest one that passed plus margin, never slower than divisor.
+# calibrating is set while it runs, then calibrated, and the divisor in use is
+# on divisor. If even divisor fails, calibration_failed is set and divisor is
+# kept. A failing divisor can leave the Peripheral part way through a frame it
+# misread. The patterns never decode as writes, calibration ends by waiting
+# for such a frame to finish, and the next access sends its full address and
+# sel, so calibrating does not disturb the memory behind the Peripheral.
+#
+# write_error is set when an ack from the Peripheral carries ACK_ERROR, ie a
+# write it posted has failed downstream, and stays set until clear_error is
+# asserted.
 class Host(Elaboratable):
-    def __init__(self, addr_width=32, data_width=64, bus_width=8, divisor=1):
+    def __init__(self, addr_width=32, data_width=64, bus_width=8, divisor=1, stream=False, compress=False, packed=False,
+                 calibrate=False, margin=1):
         if addr_width % bus_width:
             raise ValueError("addr_width={} is not a multiple of bus_width={}".format(addr_width, bus_width))
 
+        if divisor < 1 or divisor > 255:
+            raise ValueError("divisor={} must be between 1 and 255".format(divisor))
+
+        if margin < 0:
+            raise ValueError("margin={} must not be negative".format(margin))
+
         if data_width % bus_width:
             raise ValueError("data_width={} is not a multiple of bus_width={}".format(data_width, bus_width))
 
+        if packed and bus_width < 8:
+            raise ValueError("bus_width={} is too narrow for packed headers".format(bus_width))
+
+        if packed and addr_width//bus_width > 7:
+            raise ValueError("addr_width={} needs more than 7 address beats for packed headers".format(addr_width))
+
+        if packed and bus_width > 8 and sum(header_sel_fields(data_width)) > bus_width - 8:
+            raise ValueError("bus_width={} is too narrow for packed headers with data_width={}".format(bus_width, data_width))
+
         self._addr_width=addr_width
         self._data_width=data_width
         self._bus_width=bus_width
         self._divisor=divisor
+        self._stream=stream
+        self._compress=compress
+        self._packed=packed
+        self._calibrate=calibrate
+        self._margin=margin
 
         self.bus_in = Signal(bus_width)
         self.parity_in = Signal()
         self.bus_out = Signal(bus_width)
         self.parity_out = Signal()
 
-        # FIXME
         self.oe = Signal()
 
-        # FIXME
         self.clk_out = Signal()
 
+        self.start_calibration = Signal()
+        self.calibrating = Signal(reset=calibrate)
+        self.calibrated = Signal()
+        self.calibration_failed = Signal()
+        self.divisor = Signal(8)
+
+        self.write_error = Signal()
+        self.clear_error = Signal()
+
         self.wb = WishboneInterface(addr_width=addr_width, data_width=data_width, granularity=8, features=["stall"])
 
     def wb_adr_to_addr(self, adr):
@@ -86,7 +190,7 @@ class Host(Elaboratable):
 
         # Clock divider
         clock_counter = Signal(8)
-        clock_divisor = Signal(8, reset=1)
+        clock_divisor = Signal(8, reset=self._divisor)
 
         with m.If(clock_counter == 0):
             m.d.sync += clock_counter.eq(clock_divisor - 1)
@@ -97,6 +201,12 @@ class Host(Elaboratable):
         clock_strobe = Signal()
         m.d.comb += clock_strobe.eq(clock_counter == 0)
 
+        # The peripheral side of the link advances once per clk_out pulse
+        m.d.comb += [
+            self.clk_out.eq(clock_strobe),
+            self.divisor.eq(clock_divisor),
+        ]
+
         addr = Signal(self._addr_width, reset_less=True)
         data = Signal(self._data_width, reset_less=True)
         sel = Signal(self._data_width//8, reset_less=True)
@@ -108,6 +218,35 @@ class Host(Elaboratable):
         data_cycles = self._data_width//self._bus_width
         count = Signal(range(max(addr_cycles+1, data_cycles+1)))
 
+        # Zero suppression. zmask has one bit per data beat and is sent in
+        # mask_cycles beats, rotating so it is back in place afterwards
+        mask_cycles = -(-data_cycles // self._bus_width)
+        zmask = Signal(mask_cycles*self._bus_width, reset_less=True)
+        remaining = zmask[:data_cycles]
+        first = Signal(data_cycles)
+        m.d.comb += first.eq(remaining & -remaining)
+
+        compress = Signal()
+        compressed = Signal(reset_less=True)
+        nonzero = Signal(data_cycles)
+        if self._compress:
+            m.d.comb += [
+                nonzero.eq(Cat(self.wb.dat_w.word_select(i, self._bus_width).any() for i in range(data_cycles))),
+                compress.eq(mask_cycles + sum(nonzero) < data_cycles),
+            ]
+
+        def send_chunk(done_state):
+            with m.If(remaining):
+                for i in range(data_cycles):
+                    with m.If(first[i]):
+                        m.d.sync += self.bus_out.eq(data.word_select(i, self._bus_width))
+                m.d.sync += zmask.eq(zmask & ~first)
+            with m.Else():
+                m.d.sync += [
+                    self.bus_out.eq(0),
+                    state.eq(done_state),
+                ]
+
         # Some helpers
         is_write = Signal()
         is_read = Signal()
@@ -119,7 +258,121 @@ class Host(Elaboratable):
         # Disable wishbone pipelining
         m.d.comb += self.wb.stall.eq(~self.wb.ack)
 
-        state = Signal(StateEnum, reset=StateEnum.IDLE)
+        state = Signal(StateEnum, reset=StateEnum.CAL_START if self._calibrate else StateEnum.IDLE)
+
+        # Calibration. candidate is the divisor under test, best the fastest
+        # that has passed (0 for none yet). cal_count is the strobes left to
+        # wait for an echo, or to flush the link at the end.
+        patterns = Array(Const(p, self._bus_width) for p in _calibration_patterns(self._bus_width))
+        pattern = Signal(range(len(patterns)))
+        candidate = Signal(8)
+        best = Signal(8)
+        cal_timeout = 32
+        cal_flush = 2*(addr_cycles + data_cycles + 4)
+        cal_count = Signal(range(max(cal_timeout, cal_flush) + 1))
+
+        # The previous access, which the Peripheral still holds the address
+        # and sel of
+        last_adr = Signal.like(self.wb.adr)
+        last_sel = Signal.like(self.wb.sel)
+        last_we = Signal()
+        last_valid = Signal()
+
+        same_write = Signal()
+        same_read = Signal()
+        if self._stream and not self._packed:
+            m.d.comb += [
+                same_write.eq(last_valid & last_we & (self.wb.adr == last_adr) & (self.wb.sel == last_sel)),
+                same_read.eq(last_valid & ~last_we & (self.wb.adr == last_adr)),
+            ]
+
+        # Address beats to send and whether a sel beat follows them
+        addr_beats = Signal(range(addr_cycles+1))
+        send_sel = Signal()
+
+        if self._packed:
+            new_addr = Signal(self._addr_width)
+            # The address the Peripheral holds
+            held = Signal(self._addr_width)
+            incr = Signal()
+            beats = Signal(range(addr_cycles+1))
+            full = Signal()
+            header = Signal(self._bus_width)
+
+            # Cleared when the Peripheral may have lost the address, so the
+            # next access sends all of it
+            held_valid = Signal(reset=1)
+
+            m.d.comb += [
+                new_addr.eq(self.wb_adr_to_addr(self.wb.adr)),
+                incr.eq(held_valid & (new_addr == (held + self._data_width//8)[:self._addr_width])),
+            ]
+
+            # Address bits the header carries, without and with a size and lane
+            sub_word_bits = int(math.log2(self._data_width // 8))
+            (size_bits, lane_bits) = header_sel_fields(self._data_width)
+            low_bits = max(0, min(self._bus_width - 8, self._addr_width - sub_word_bits))
+            low_bits_sel = max(0, min(self._bus_width - 8 - size_bits - lane_bits, self._addr_width - sub_word_bits))
+            low_mask = Const((2**low_bits - 1) << sub_word_bits, self._addr_width)
+            low_mask_sel = Const((2**low_bits_sel - 1) << sub_word_bits, self._addr_width)
+
+            if self._bus_width > 8:
+                size = Signal(size_bits)
+                lane = Signal(lane_bits)
+                for i in range(lane_bits + 1):
+                    for j in range(len(self.wb.sel) - 2**i + 1):
+                        with m.If(self.wb.sel == (2**(2**i) - 1) << j):
+                            m.d.comb += [
+                                full.eq(self.wb.we),
+                                size.eq(i),
+                                lane.eq(j),
+                            ]
+                fields = Mux(full, Cat(size, lane, new_addr[sub_word_bits:sub_word_bits+low_bits_sel]),
+                             new_addr[sub_word_bits:sub_word_bits+low_bits])
+            else:
+                m.d.comb += full.eq(self.wb.we & (self.wb.sel == 2**len(self.wb.sel) - 1))
+                fields = Const(0, 0)
+
+            changed = Signal(self._addr_width)
+            m.d.comb += changed.eq((new_addr ^ held) & ~Mux(full, low_mask_sel, low_mask))
+
+            # Up to and including the highest beat that changed
+            for i in range(addr_cycles):
+                with m.If(changed.word_select(i, self._bus_width).any() & ~incr):
+                    m.d.comb += beats.eq(i+1)
+            with m.If(~held_valid):
+                m.d.comb += beats.eq(addr_cycles)
+
+            m.d.comb += header.eq(Cat((HEADER_V1 | Mux(self.wb.we, HEADER_WE, 0) | (beats << HEADER_ADDR_SHIFT) |
+                                       Mux(incr, HEADER_INCR, 0) | Mux(compress & self.wb.we, HEADER_Z, 0) |
+                                       Mux(full, HEADER_FULL, 0))[:8], fields))
+
+        def start_data():
+            with m.If(compressed):
+                m.d.sync += [
+                    count.eq(mask_cycles-1),
+                    self.bus_out.eq(zmask[:self._bus_width]),
+                    zmask.eq(zmask.rotate_right(self._bus_width)),
+                    state.eq(StateEnum.WRITE_MASK),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    count.eq(data_cycles-1),
+                    self.bus_out.eq(data[:self._bus_width]),
+                    data.eq(data[self._bus_width:]),
+                    state.eq(StateEnum.WRITE_DATA),
+                ]
+
+        # An ack, with or without ACK_ERROR
+        def is_ack(cmd):
+            return (self.bus_in | ACK_ERROR) == (cmd | ACK_ERROR)
+
+        def ack_error():
+            with m.If(self.bus_in & ACK_ERROR):
+                m.d.sync += self.write_error.eq(1)
+
+        with m.If(self.clear_error):
+            m.d.sync += self.write_error.eq(0)
 
         with m.Switch(state):
             with m.Case(StateEnum.IDLE):
@@ -128,42 +381,110 @@ class Host(Elaboratable):
                     self.wb.ack.eq(0),
                 ]
 
+                # Accesses come first
+                with m.If(self.start_calibration & ~(clock_strobe & (is_write | is_read))):
+                    m.d.sync += state.eq(StateEnum.CAL_START)
+
+                with m.If(clock_strobe & (is_write | is_read)):
+                    m.d.sync += [
+                        last_adr.eq(self.wb.adr),
+                        last_sel.eq(self.wb.sel),
+                        last_we.eq(self.wb.we),
+                        last_valid.eq(1),
+                    ]
+
                 with m.If(clock_strobe):
                     with m.If(is_write):
                         m.d.sync += [
-                            addr.eq(self.wb_adr_to_addr(self.wb.adr)),
                             data.eq(self.wb.dat_w),
-                            sel.eq(self.wb.sel),
-
-                            self.bus_out.eq(CmdEnum.WRITE),
-                            state.eq(StateEnum.WRITE_CMD),
+                            zmask.eq(nonzero),
+                            compressed.eq(compress),
                         ]
 
-                    with m.Elif(is_read):
+                    if self._packed:
+                        with m.If(is_write | is_read):
+                            m.d.sync += [
+                                addr.eq(new_addr),
+                                held.eq(new_addr),
+                                held_valid.eq(1),
+                                sel.eq(self.wb.sel),
+                                addr_beats.eq(beats),
+                                send_sel.eq(~full),
+
+                                self.bus_out.eq(header),
+                            ]
+                        with m.If(is_write):
+                            m.d.sync += state.eq(StateEnum.WRITE_CMD)
+                        with m.Elif(is_read):
+                            m.d.sync += state.eq(StateEnum.READ_CMD)
+
+                    else:
                         m.d.sync += [
-                            addr.eq(self.wb_adr_to_addr(self.wb.adr)),
-
-                            self.bus_out.eq(CmdEnum.READ),
-                            state.eq(StateEnum.READ_CMD),
+                            addr_beats.eq(addr_cycles),
+                            send_sel.eq(1),
                         ]
 
+                        with m.If(is_write & same_write):
+                            # Straight on to the data
+                            m.d.sync += [
+                                self.bus_out.eq(Mux(compress, CmdEnum.WRITE_STREAM_Z, CmdEnum.WRITE_STREAM)),
+                                state.eq(StateEnum.WRITE_SEL),
+                            ]
+
+                        with m.Elif(is_write):
+                            m.d.sync += [
+                                addr.eq(self.wb_adr_to_addr(self.wb.adr)),
+                                sel.eq(self.wb.sel),
+
+                                self.bus_out.eq(Mux(compress, CmdEnum.WRITE_Z, CmdEnum.WRITE)),
+                                state.eq(StateEnum.WRITE_CMD),
+                            ]
+
+                        with m.Elif(is_read & same_read):
+                            m.d.sync += [
+                                self.bus_out.eq(CmdEnum.READ_STREAM),
+                                state.eq(StateEnum.READ_ACK),
+                            ]
+
+                        with m.Elif(is_read):
+                            m.d.sync += [
+                                addr.eq(self.wb_adr_to_addr(self.wb.adr)),
+
+                                self.bus_out.eq(CmdEnum.READ),
+                                state.eq(StateEnum.READ_CMD),
+                            ]
+
             with m.Case(StateEnum.WRITE_CMD):
                 with m.If(clock_strobe):
-                    m.d.sync += [
-                        count.eq(addr_cycles-1),
-                        self.bus_out.eq(addr[:self._bus_width]),
-                        addr.eq(addr[self._bus_width:]),
-                        state.eq(StateEnum.WRITE_ADDR),
-                    ]
+                    with m.If(addr_beats):
+                        m.d.sync += [
+                            count.eq(addr_beats-1),
+                            self.bus_out.eq(addr[:self._bus_width]),
+                            addr.eq(addr[self._bus_width:]),
+                            state.eq(StateEnum.WRITE_ADDR),
+                        ]
+                    with m.Elif(send_sel):
+                        m.d.sync += [
+                            self.bus_out.eq(sel),
+                            state.eq(StateEnum.WRITE_SEL),
+                        ]
+                    with m.Else():
+                        start_data()
 
             with m.Case(StateEnum.READ_CMD):
                 with m.If(clock_strobe):
-                    m.d.sync += [
-                        count.eq(addr_cycles-1),
-                        self.bus_out.eq(addr[:self._bus_width]),
-                        addr.eq(addr[self._bus_width:]),
-                        state.eq(StateEnum.READ_ADDR),
-                    ]
+                    with m.If(addr_beats):
+                        m.d.sync += [
+                            count.eq(addr_beats-1),
+                            self.bus_out.eq(addr[:self._bus_width]),
+                            addr.eq(addr[self._bus_width:]),
+                            state.eq(StateEnum.READ_ADDR),
+                        ]
+                    with m.Else():
+                        m.d.sync += [
+                            self.bus_out.eq(0),
+                            state.eq(StateEnum.READ_ACK),
+                        ]
 
             with m.Case(StateEnum.WRITE_ADDR):
                 with m.If(clock_strobe):
@@ -173,11 +494,13 @@ class Host(Elaboratable):
                             addr.eq(addr[self._bus_width:]),
                             count.eq(count - 1),
                         ]
-                    with m.Else():
+                    with m.Elif(send_sel):
                         m.d.sync += [
                             self.bus_out.eq(sel),
                             state.eq(StateEnum.WRITE_SEL),
                         ]
+                    with m.Else():
+                        start_data()
 
             with m.Case(StateEnum.READ_ADDR):
                 with m.If(clock_strobe):
@@ -195,12 +518,7 @@ class Host(Elaboratable):
 
             with m.Case(StateEnum.WRITE_SEL):
                 with m.If(clock_strobe):
-                    m.d.sync += [
-                        count.eq(data_cycles-1),
-                        self.bus_out.eq(data[:self._bus_width]),
-                        data.eq(data[self._bus_width:]),
-                        state.eq(StateEnum.WRITE_DATA),
-                    ]
+                    start_data()
 
             with m.Case(StateEnum.WRITE_DATA):
                 with m.If(clock_strobe):
@@ -216,9 +534,26 @@ class Host(Elaboratable):
                             state.eq(StateEnum.WRITE_ACK),
                         ]
 
+            with m.Case(StateEnum.WRITE_MASK):
+                with m.If(clock_strobe):
+                    with m.If(count):
+                        m.d.sync += [
+                            self.bus_out.eq(zmask[:self._bus_width]),
+                            zmask.eq(zmask.rotate_right(self._bus_width)),
+                            count.eq(count - 1),
+                        ]
+                    with m.Else():
+                        m.d.sync += state.eq(StateEnum.WRITE_ZDATA)
+                        send_chunk(StateEnum.WRITE_ACK)
+
+            with m.Case(StateEnum.WRITE_ZDATA):
+                with m.If(clock_strobe):
+                    send_chunk(StateEnum.WRITE_ACK)
+
             with m.Case(StateEnum.WRITE_ACK):
                 with m.If(clock_strobe):
-                    with m.If(self.bus_in == CmdEnum.WRITE_ACK):
+                    with m.If(is_ack(CmdEnum.WRITE_ACK)):
+                        ack_error()
                         m.d.sync += [
                             self.wb.ack.eq(1),
                             state.eq(StateEnum.WISHBONE_ACK),
@@ -226,12 +561,44 @@ class Host(Elaboratable):
 
             with m.Case(StateEnum.READ_ACK):
                 with m.If(clock_strobe):
-                    with m.If(self.bus_in == CmdEnum.READ_ACK):
+                    m.d.sync += self.bus_out.eq(0)
+                    with m.If(is_ack(CmdEnum.READ_ACK)):
+                        ack_error()
                         m.d.sync += [
                             count.eq(data_cycles),
                             data.eq(0),
                             state.eq(StateEnum.READ_DATA),
                         ]
+                    if self._compress:
+                        with m.Elif(is_ack(CmdEnum.READ_ACK_Z)):
+                            ack_error()
+                            m.d.sync += [
+                                count.eq(mask_cycles),
+                                data.eq(0),
+                                state.eq(StateEnum.READ_MASK),
+                            ]
+
+            with m.Case(StateEnum.READ_MASK):
+                with m.If(clock_strobe):
+                    m.d.sync += [
+                        zmask.eq(Cat(zmask[self._bus_width:], self.bus_in)),
+                        count.eq(count - 1),
+                    ]
+                    with m.If(count == 1):
+                        m.d.sync += state.eq(StateEnum.READ_ZDATA)
+
+            with m.Case(StateEnum.READ_ZDATA):
+                with m.If(clock_strobe):
+                    with m.If(remaining):
+                        for i in range(data_cycles):
+                            with m.If(first[i]):
+                                m.d.sync += data.word_select(i, self._bus_width).eq(self.bus_in)
+                        m.d.sync += zmask.eq(zmask & ~first)
+                    with m.Else():
+                        m.d.sync += [
+                            self.wb.ack.eq(1),
+                            state.eq(StateEnum.WISHBONE_ACK),
+                        ]
 
             with m.Case(StateEnum.READ_DATA):
                 with m.If(clock_strobe):
@@ -247,6 +614,103 @@ class Host(Elaboratable):
                         ]
 
 
+            with m.Case(StateEnum.CAL_START):
+                m.d.sync += [
+                    candidate.eq(self._divisor),
+                    clock_divisor.eq(self._divisor),
+                    best.eq(0),
+                    pattern.eq(0),
+
+                    self.calibrating.eq(1),
+                    self.calibrated.eq(0),
+                    self.calibration_failed.eq(0),
+
+                    state.eq(StateEnum.CAL_CMD),
+                ]
+
+            with m.Case(StateEnum.CAL_CMD):
+                with m.If(clock_strobe):
+                    m.d.sync += [
+                        self.bus_out.eq(CmdEnum.ECHO),
+                        state.eq(StateEnum.CAL_PATTERN),
+                    ]
+
+            with m.Case(StateEnum.CAL_PATTERN):
+                with m.If(clock_strobe):
+                    m.d.sync += [
+                        self.bus_out.eq(patterns[pattern]),
+                        cal_count.eq(cal_timeout),
+                        state.eq(StateEnum.CAL_WAIT),
+                    ]
+
+            with m.Case(StateEnum.CAL_WAIT):
+                with m.If(clock_strobe):
+                    m.d.sync += self.bus_out.eq(0)
+                    with m.If(self.bus_in == CmdEnum.ECHO_ACK):
+                        m.d.sync += state.eq(StateEnum.CAL_CHECK)
+                    with m.Elif(cal_count == 0):
+                        m.d.sync += state.eq(StateEnum.CAL_END)
+                    with m.Else():
+                        m.d.sync += cal_count.eq(cal_count - 1)
+
+            with m.Case(StateEnum.CAL_CHECK):
+                with m.If(clock_strobe):
+                    with m.If((self.bus_in != patterns[pattern]) | (self.parity_in != self.bus_in.xor())):
+                        m.d.sync += state.eq(StateEnum.CAL_END)
+                    with m.Elif(pattern != len(patterns) - 1):
+                        m.d.sync += [
+                            pattern.eq(pattern + 1),
+                            state.eq(StateEnum.CAL_CMD),
+                        ]
+                    with m.Elif(candidate == 1):
+                        m.d.sync += [
+                            best.eq(candidate),
+                            state.eq(StateEnum.CAL_END),
+                        ]
+                    with m.Else():
+                        # Passed, try the next divisor down
+                        m.d.sync += [
+                            best.eq(candidate),
+                            candidate.eq(candidate - 1),
+                            clock_divisor.eq(candidate - 1),
+                            pattern.eq(0),
+                            state.eq(StateEnum.CAL_CMD),
+                        ]
+
+            with m.Case(StateEnum.CAL_END):
+                with m.If(best == 0):
+                    m.d.sync += [
+                        clock_divisor.eq(self._divisor),
+                        self.calibration_failed.eq(1),
+                    ]
+                with m.Elif(best + self._margin >= self._divisor):
+                    m.d.sync += clock_divisor.eq(self._divisor)
+                with m.Else():
+                    m.d.sync += clock_divisor.eq(best + self._margin)
+
+                m.d.sync += [
+                    self.bus_out.eq(0),
+                    cal_count.eq(cal_flush),
+                    state.eq(StateEnum.CAL_FLUSH),
+                ]
+
+            # Give a Peripheral that misread a frame time to get back to IDLE
+            with m.Case(StateEnum.CAL_FLUSH):
+                with m.If(clock_strobe):
+                    with m.If(cal_count):
+                        m.d.sync += cal_count.eq(cal_count - 1)
+                    with m.Else():
+                        # A misread frame may have changed the address and
+                        # sel the Peripheral holds
+                        m.d.sync += [
+                            last_valid.eq(0),
+                            self.calibrating.eq(0),
+                            self.calibrated.eq(1),
+                            state.eq(StateEnum.IDLE),
+                        ]
+                        if self._packed:
+                            m.d.sync += held_valid.eq(0)
+
             with m.Case(StateEnum.WISHBONE_ACK):
                 m.d.sync += [
                     self.wb.ack.eq(0),
@@ -255,9 +719,18 @@ class Host(Elaboratable):
 
         m.d.comb += self.parity_out.eq(self.bus_out.xor())
 
+        # Set while bus_out holds a command, address, sel, mask, data or
+        # calibration beat. The echo pattern is held until the first strobe
+        # of CAL_WAIT.
+        m.d.comb += self.oe.eq((state == StateEnum.WRITE_CMD) | (state == StateEnum.READ_CMD) |
+                               (state == StateEnum.WRITE_ADDR) | (state == StateEnum.READ_ADDR) |
+                               (state == StateEnum.WRITE_SEL) | (state == StateEnum.WRITE_DATA) |
+                               (state == StateEnum.WRITE_MASK) | (state == StateEnum.WRITE_ZDATA) |
+                               (state == StateEnum.CAL_PATTERN) | ((state == StateEnum.CAL_WAIT) & (cal_count == cal_timeout)))
+
         return m
 
 if __name__ == "__main__":
     top = Host(addr_width=32, data_width=64, bus_width=8)
     with open("host.v", "w") as f:
-        f.write(verilog.convert(top, ports=[top.bus_in, top.parity_in, top.bus_out, top.parity_out, top.oe, top.wb.adr, top.wb.dat_w, top.wb.dat_r, top.wb.sel, top.wb.cyc, top.wb.stb, top.wb.we, top.wb.ack, top.wb.stall], name="host_top", strip_internal_attrs=True))
+        f.write(verilog.convert(top, ports=[top.bus_in, top.parity_in, top.bus_out, top.parity_out, top.oe, top.clk_out, top.start_calibration, top.calibrating, top.calibrated, top.calibration_failed, top.divisor, top.write_error, top.clear_error, top.wb.adr, top.wb.dat_w, top.wb.dat_r, top.wb.sel, top.wb.cyc, top.wb.stb, top.wb.we, top.wb.ack, top.wb.stall], name="host_top", strip_internal_attrs=True))
@@ -0,0 +1,162 @@
+# Transaction traces of the link and a utilization analyzer
+#
+# TraceProbe watches a Host and the Peripheral on the other end of its link
+# and records one entry per Wishbone access: when it was presented, the op,
+# adr and sel, how many cycles it took until ack and how its link strobes
+# split into request beats (driven by the Host), wait strobes (nobody
+# driving) and response beats (driven by the Peripheral). gap is the number
+# of cycles the Wishbone side was idle before the access. Link strobes while
+# no access is outstanding are not counted.
+#
+# Traces are written as JSON lines, the first line holding the link widths.
+# Run this file on a trace to report payload efficiency, latency percentiles
+# and idle gaps, e.g.
+#
+#   python traffic.py --trace out.jsonl && python linktrace.py out.jsonl
+
+import json
+
+from nmigen.sim import Passive, Settle
+
+
+class TraceProbe:
+    # f, if given, is a text file the trace is written to as it is recorded
+    def __init__(self, host, peripheral, f=None):
+        self.host = host
+        self.peripheral = peripheral
+        self.f = f
+
+        self.header = {
+            "bus_width": len(host.bus_out),
+            "data_width": len(host.wb.dat_w),
+        }
+        self.records = []
+
+        if f is not None:
+            f.write(json.dumps(self.header) + "\n")
+
+    # Add with Simulator.add_sync_process()
+    def process(self):
+        yield Passive()
+
+        wb = self.host.wb
+        cycle = 0
+        last_end = -1
+        record = None
+
+        while True:
+            # See the accesses the testbench presented this cycle
+            yield Settle()
+
+            if record is None and (yield wb.cyc) and (yield wb.stb):
+                record = {
+                    "start": cycle,
+                    "op": "write" if (yield wb.we) else "read",
+                    "adr": (yield wb.adr),
+                    "sel": (yield wb.sel),
+                    "cycles": 0,
+                    "request": 0,
+                    "wait": 0,
+                    "response": 0,
+                    "gap": cycle - last_end - 1,
+                }
+
+            if record is not None:
+                if (yield self.host.clk_out):
+                    if (yield self.host.oe):
+                        record["request"] += 1
+                    elif (yield self.peripheral.oe):
+                        record["response"] += 1
+                    else:
+                        record["wait"] += 1
+
+                if (yield wb.ack):
+                    record["cycles"] = cycle - record["start"] + 1
+                    self.add(record)
+                    last_end = cycle
+                    record = None
+
+            yield
+            cycle += 1
+
+    def add(self, record):
+        self.records.append(record)
+        if self.f is not None:
+            self.f.write(json.dumps(record) + "\n")
+
+
+def load(f):
+    lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or "op" in lines[0]:
+        raise ValueError("trace has no header line")
+
+    return (lines[0], lines[1:])
+
+
+# Nearest rank percentile of sorted values
+def percentile(values, p):
+    if not values:
+        return 0
+    rank = max(1, -(-len(values)*p // 100))
+    return values[int(rank) - 1]
+
+
+def analyze(header, records):
+    bus_width = header["bus_width"]
+
+    if not records:
+        return {"transactions": 0}
+
+    strobes = sum(r["request"] + r["wait"] + r["response"] for r in records)
+    beats = sum(r["request"] + r["response"] for r in records)
+    payload = sum(bin(r["sel"]).count("1")*8 for r in records)
+    gaps = [r["gap"] for r in records]
+    span = records[-1]["start"] + records[-1]["cycles"] - records[0]["start"] + records[0]["gap"]
+
+    report = {
+        "transactions": len(records),
+        "reads": sum(1 for r in records if r["op"] == "read"),
+        "writes": sum(1 for r in records if r["op"] == "write"),
+        "cycles": span,
+        "link_strobes": strobes,
+        # Share of link strobes either side drove, and of the bits those
+        # strobes could have carried that were payload (selected bytes)
+        "link_busy": beats / strobes if strobes else 0,
+        "payload_efficiency": payload / (strobes*bus_width) if strobes else 0,
+        "idle_cycles": sum(gaps),
+        "idle_fraction": sum(gaps) / span if span else 0,
+        "back_to_back": sum(1 for g in gaps if g == 0) / len(gaps),
+        "max_gap": max(gaps),
+    }
+
+    for op in ("read", "write"):
+        latencies = sorted(r["cycles"] for r in records if r["op"] == op)
+        for p in (50, 90, 99):
+            report["{}_latency_p{}".format(op, p)] = percentile(latencies, p)
+        report["{}_latency_max".format(op)] = latencies[-1] if latencies else 0
+
+        phases = [r for r in records if r["op"] == op]
+        for phase in ("request", "wait", "response"):
+            report["{}_{}".format(op, phase)] = sum(r[phase] for r in phases) / len(phases) if phases else 0
+
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report link utilization from a transaction trace")
+    parser.add_argument("trace", help="JSON lines trace written by TraceProbe")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    args = parser.parse_args()
+
+    with open(args.trace) as f:
+        (header, records) = load(f)
+
+    report = analyze(header, records)
+
+    if args.format == "json":
+        print(json.dumps(report, indent=2))
+    else:
+        for (field, value) in report.items():
+            print("{:24} {}".format(field, "{:.3f}".format(value) if isinstance(value, float) else value))
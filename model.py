@@ -0,0 +1,508 @@
+# Transaction level model of Host + Peripheral + RAM
+#
+# Frames are built and parsed beat by beat with the same CmdEnum framing the
+# gateware uses, but each access is a single Python call. Cycle counts are
+# those seen by a classic Wishbone master issuing one access at a time (ie
+# Helpers.wishbone_read/wishbone_write against System), so the model can be
+# used for firmware tests and throughput estimates without running the
+# cycle level simulator.
+#
+# With fast=True (the default) the Host only works out how many beats each
+# frame takes and accesses the RAM directly, which gives the same data and
+# cycle counts without building the frames. fast=False goes through the
+# Peripheral beat by beat, for checking the framing itself.
+
+import math
+
+from cmd import CmdEnum, HEADER_V1, HEADER_WE, HEADER_ADDR_SHIFT, HEADER_INCR, HEADER_Z, HEADER_FULL, HEADER_WIDE_SHIFT, header_sel_fields
+
+
+class RAMModel:
+    # latency is the number of cycles from stb to ack. Words not in data are
+    # filled in from init(adr).
+    def __init__(self, addr_width, data_width, data=None, init=None, latency=1):
+        self.addr_width = addr_width
+        self.data_width = data_width
+        self.init = init
+        self.latency = latency
+
+        self._mask = 2**addr_width - 1
+        self._data_mask = 2**data_width - 1
+
+        self.data = dict()
+        if data is not None:
+            assert(len(data) <= 2**addr_width)
+            for i, d in enumerate(data):
+                self.data[i] = d & self._data_mask
+
+    def read(self, adr):
+        adr = adr & self._mask
+        if adr not in self.data:
+            self.data[adr] = self.init(adr) & self._data_mask if self.init is not None else 0
+        return self.data[adr]
+
+    def write(self, adr, data, sel):
+        adr = adr & self._mask
+        old = self.read(adr)
+        mask = 0
+        for i in range(self.data_width // 8):
+            if sel & (1 << i):
+                mask |= 0xff << (i*8)
+        self.data[adr] = (old & ~mask) | (data & mask)
+
+
+def _to_beats(value, cycles, bus_width):
+    beats = []
+    for i in range(cycles):
+        beats.append(value & (2**bus_width - 1))
+        value = value >> bus_width
+    return beats
+
+
+def _from_beats(beats, bus_width):
+    value = 0
+    for i, b in enumerate(beats):
+        value = value | (b << (i*bus_width))
+    return value
+
+
+# Zero suppressed data beats, see Host. Returns (compressed, beats).
+def _encode(value, data_cycles, bus_width):
+    beats = _to_beats(value, data_cycles, bus_width)
+    mask_cycles = -(-data_cycles // bus_width)
+    nonzero = [b for b in beats if b]
+
+    if mask_cycles + len(nonzero) < data_cycles:
+        mask = sum(1 << i for (i, b) in enumerate(beats) if b)
+        return (True, _to_beats(mask, mask_cycles, bus_width) + nonzero)
+
+    return (False, beats)
+
+
+def _decode(compressed, beats, data_cycles, bus_width):
+    if not compressed:
+        return _from_beats(beats[:data_cycles], bus_width)
+
+    mask_cycles = -(-data_cycles // bus_width)
+    mask = _from_beats(beats[:mask_cycles], bus_width)
+    nonzero = iter(beats[mask_cycles:])
+
+    value = 0
+    for i in range(data_cycles):
+        if mask & (1 << i):
+            value = value | (next(nonzero) << (i*bus_width))
+    return value
+
+
+# Word address bits a wide packed header carries, without and with a size
+# and byte lane, see Host
+def _header_low_bits(addr_width, data_width, bus_width):
+    if bus_width <= 8:
+        return (0, 0)
+
+    sub_word_bits = int(math.log2(data_width // 8))
+    spare = bus_width - 8
+    return (max(0, min(spare, addr_width - sub_word_bits)),
+            max(0, min(spare - sum(header_sel_fields(data_width)), addr_width - sub_word_bits)))
+
+
+class PeripheralModel:
+    # With post_writes=True writes are acked once their data has arrived and
+    # queued for the bus, see Peripheral. pipelined only changes how fast the
+    # queue drains.
+    def __init__(self, bus, addr_width=32, data_width=64, bus_width=8, pipelined=False, post_writes=False, post_depth=4, compress=False):
+        if addr_width % bus_width:
+            raise ValueError("addr_width={} is not a multiple of bus_width={}".format(addr_width, bus_width))
+
+        if data_width % bus_width:
+            raise ValueError("data_width={} is not a multiple of bus_width={}".format(data_width, bus_width))
+
+        self._addr_width = addr_width
+        self._data_width = data_width
+        self._bus_width = bus_width
+
+        self.addr_cycles = addr_width // bus_width
+        self.data_cycles = data_width // bus_width
+        self.sub_word_bits = int(math.log2(data_width // 8))
+
+        self.bus = bus
+
+        self.pipelined = pipelined
+        self.post_writes = post_writes
+        self.post_depth = post_depth
+        self.compress = compress
+
+        # (start, ack) cycle of each posted write still in the queue
+        self.queue = []
+
+        # Left over from the previous command for READ_STREAM and WRITE_STREAM
+        self.adr = 0
+        self.sel = 0
+
+    # Consume one command frame, return the response frame
+    def transact(self, beats):
+        cmd = beats[0]
+
+        if cmd & HEADER_V1:
+            return self.transact_packed(beats)
+
+        if cmd in (CmdEnum.WRITE, CmdEnum.READ, CmdEnum.WRITE_Z):
+            a = 1 + self.addr_cycles
+            addr = _from_beats(beats[1:a], self._bus_width)
+            self.adr = addr >> self.sub_word_bits
+            beats = beats[a:]
+        else:
+            beats = beats[1:]
+
+        if cmd in (CmdEnum.WRITE, CmdEnum.WRITE_Z):
+            self.sel = beats[0]
+            beats = beats[1:]
+
+        if cmd in (CmdEnum.WRITE, CmdEnum.WRITE_STREAM, CmdEnum.WRITE_Z, CmdEnum.WRITE_STREAM_Z):
+            compressed = cmd in (CmdEnum.WRITE_Z, CmdEnum.WRITE_STREAM_Z)
+            data = _decode(compressed, beats, self.data_cycles, self._bus_width)
+            self.bus.write(self.adr, data, self.sel)
+            return [CmdEnum.WRITE_ACK]
+
+        elif cmd in (CmdEnum.READ, CmdEnum.READ_STREAM):
+            data = self.bus.read(self.adr)
+            if self.compress:
+                (compressed, beats) = _encode(data, self.data_cycles, self._bus_width)
+            else:
+                (compressed, beats) = (False, _to_beats(data, self.data_cycles, self._bus_width))
+            return [CmdEnum.READ_ACK_Z if compressed else CmdEnum.READ_ACK] + beats
+
+        raise ValueError("Unknown command {:#x}".format(cmd))
+
+    def transact_packed(self, beats):
+        header = beats[0]
+        addr_beats = (header >> HEADER_ADDR_SHIFT) & 7
+        full = header & HEADER_WE and header & HEADER_FULL
+        beats = beats[1:]
+
+        addr = self.adr << self.sub_word_bits
+        if header & HEADER_INCR:
+            addr = addr + self._data_width//8
+
+        sel = 2**(self._data_width//8) - 1
+        fields = header >> HEADER_WIDE_SHIFT
+        (low_bits, low_bits_sel) = _header_low_bits(self._addr_width, self._data_width, self._bus_width)
+        if full and low_bits:
+            (size_bits, lane_bits) = header_sel_fields(self._data_width)
+            size = fields & (2**size_bits - 1)
+            lane = (fields >> size_bits) & (2**lane_bits - 1)
+            sel = ((2**(2**size) - 1) << lane) & sel
+            (fields, low_bits) = (fields >> (size_bits + lane_bits), low_bits_sel)
+        low_mask = (2**low_bits - 1) << self.sub_word_bits
+        addr = (addr & ~low_mask) | ((fields << self.sub_word_bits) & low_mask)
+
+        for i in range(addr_beats):
+            shift = i*self._bus_width
+            addr = (addr & ~((2**self._bus_width - 1) << shift)) | (beats[i] << shift)
+        self.adr = (addr & (2**self._addr_width - 1)) >> self.sub_word_bits
+        beats = beats[addr_beats:]
+
+        if not header & HEADER_WE:
+            return self.transact([CmdEnum.READ_STREAM])
+
+        if full:
+            self.sel = sel
+        else:
+            self.sel = beats[0]
+            beats = beats[1:]
+
+        return self.transact([CmdEnum.WRITE_STREAM_Z if header & HEADER_Z else CmdEnum.WRITE_STREAM] + beats)
+
+    # Queue a posted write whose last data beat arrives at cycle t. Returns the
+    # cycle it is accepted, which is later than t if the queue is full.
+    def post(self, t, divisor):
+        def level(t):
+            # An entry leaves the queue when the bus accepts it in pipelined
+            # mode, or when it is acked in classic mode
+            return sum(1 for (start, ack) in self.queue if (start if self.pipelined else ack) + divisor > t)
+
+        while level(t) >= self.post_depth:
+            t += divisor
+
+        start = t + divisor
+        if self.queue:
+            (prev_start, prev_ack) = self.queue[-1]
+            start = max(start, (prev_start if self.pipelined else prev_ack) + divisor)
+
+        self.queue = [e for e in self.queue if e[1] + divisor > t] + [(start, start + self.bus.latency*divisor)]
+        return t
+
+    # First cycle a read can be issued after all posted writes have completed
+    def drained(self, divisor):
+        if not self.queue:
+            return 0
+        return self.queue[-1][1] + divisor
+
+
+class HostModel:
+    # Cycle the Wishbone master spends presenting the access, and the cycle it
+    # takes to sample wb.ack once the Host has raised it
+    master_cycles = 2
+
+    def __init__(self, peripheral, addr_width=32, data_width=64, bus_width=8, divisor=1, stream=False, compress=False, packed=False,
+                 fast=True):
+        if addr_width % bus_width:
+            raise ValueError("addr_width={} is not a multiple of bus_width={}".format(addr_width, bus_width))
+
+        if data_width % bus_width:
+            raise ValueError("data_width={} is not a multiple of bus_width={}".format(data_width, bus_width))
+
+        self._addr_width = addr_width
+        self._data_width = data_width
+        self._bus_width = bus_width
+        self._divisor = divisor
+        self._stream = stream
+        self._compress = compress
+        self._packed = packed
+        self._fast = fast
+
+        self.addr_cycles = addr_width // bus_width
+        self.data_cycles = data_width // bus_width
+        self.mask_cycles = -(-self.data_cycles // bus_width)
+        self.wb_shift = int(math.log2(data_width // 8))
+        self.low_bits = _header_low_bits(addr_width, data_width, bus_width)
+
+        self.peripheral = peripheral
+
+        # (adr, sel, we) of the previous access
+        self.last = None
+
+        # The address the Peripheral holds, for packed headers
+        self.held = 0
+
+        self.cycles = 0
+        self.beats_out = 0
+        self.beats_in = 0
+
+    def wb_adr_to_addr(self, adr):
+        return (adr << self.wb_shift) & (2**self._addr_width - 1)
+
+    def idle(self, cycles):
+        self.cycles += cycles
+
+    def _transact(self, beats, write, extra_beats=0):
+        response = self.peripheral.transact(beats)
+        return (response, self._timing(len(beats), len(response), write, extra_beats))
+
+    # Cycles taken by an access with a command frame of out_beats and a
+    # response of in_beats
+    def _timing(self, out_beats, in_beats, write, extra_beats=0):
+        self.beats_out += out_beats
+        self.beats_in += in_beats
+
+        # The Host only leaves IDLE on a clock strobe, which comes every divisor
+        # cycles starting the cycle before the master's first clock. From there
+        # every step on both sides of the link happens once per strobe: the
+        # command frame, the downstream access, the Peripheral registering its
+        # response, the response frame and the Host registering the ack.
+        wait = -(self.cycles + 1) % self._divisor
+        start = self.cycles + wait
+        stall = 0
+
+        if self.peripheral.post_writes and write:
+            # Acked as soon as the write is queued, the downstream access
+            # happens later
+            last = start + (out_beats - 1)*self._divisor
+            stall = self.peripheral.post(last, self._divisor) - last
+            strobes = out_beats + in_beats + extra_beats
+        else:
+            if self.peripheral.post_writes:
+                # Reads wait for the queue to drain
+                stall = max(0, self.peripheral.drained(self._divisor) - (start + out_beats*self._divisor))
+            strobes = out_beats + self.peripheral.bus.latency + 1 + in_beats + extra_beats
+
+        cycles = wait + stall + strobes*self._divisor + self.master_cycles
+
+        self.cycles += cycles
+        return cycles
+
+    # Number of data beats for value, and whether they are zero suppressed,
+    # as _encode() would send them
+    def _data_length(self, value, compress):
+        if compress:
+            beat_mask = 2**self._bus_width - 1
+            nonzero = sum(1 for i in range(self.data_cycles) if (value >> (i*self._bus_width)) & beat_mask)
+            if self.mask_cycles + nonzero < self.data_cycles:
+                return (True, self.mask_cycles + nonzero)
+        return (False, self.data_cycles)
+
+    # Number of beats in the packed header and address beats, as
+    # _packed_header() would send them
+    def _packed_length(self, adr, full):
+        addr = self.wb_adr_to_addr(adr)
+        (low_bits, low_bits_sel) = self.low_bits
+        if full is not None:
+            low_bits = low_bits_sel
+        low_mask = (2**low_bits - 1) << self.wb_shift
+
+        if addr == (self.held + self._data_width//8) & (2**self._addr_width - 1):
+            length = 1
+        else:
+            changed = (addr ^ self.held) & ~low_mask
+            length = 1 - (-changed.bit_length() // self._bus_width)
+        self.held = addr
+        return length
+
+    # The size and byte lane that replace sel in a wide packed header, or
+    # None if it needs a sel beat
+    def _header_sel(self, sel):
+        if self._bus_width <= 8:
+            return (0, 0) if sel == 2**(self._data_width//8) - 1 else None
+
+        for size in range(self.wb_shift + 1):
+            for lane in range(self._data_width//8 - 2**size + 1):
+                if sel == (2**(2**size) - 1) << lane:
+                    return (size, lane)
+        return None
+
+    # Packed header and address beats. full is the (size, lane) of a write
+    # that needs no sel beat.
+    def _packed_header(self, adr, we, full, compressed):
+        addr = self.wb_adr_to_addr(adr)
+        mask = 2**self._addr_width - 1
+
+        (low_bits, low_bits_sel) = _header_low_bits(self._addr_width, self._data_width, self._bus_width)
+        fields = 0
+        if full is not None and low_bits:
+            (size_bits, lane_bits) = header_sel_fields(self._data_width)
+            (size, lane) = full
+            fields = size | (lane << size_bits)
+            fields |= (addr >> self.wb_shift) % 2**low_bits_sel << (size_bits + lane_bits)
+            low_bits = low_bits_sel
+        else:
+            fields = (addr >> self.wb_shift) % 2**low_bits
+        low_mask = (2**low_bits - 1) << self.wb_shift
+
+        beats = []
+        header = HEADER_V1 | (fields << HEADER_WIDE_SHIFT)
+        if addr == (self.held + self._data_width//8) & mask:
+            header |= HEADER_INCR
+        else:
+            changed = (addr ^ self.held) & ~low_mask
+            for i in range(self.addr_cycles):
+                if changed >> (i*self._bus_width):
+                    beats = _to_beats(addr, i+1, self._bus_width)
+        self.held = addr
+
+        header |= len(beats) << HEADER_ADDR_SHIFT
+        if we:
+            header |= HEADER_WE
+        if full is not None:
+            header |= HEADER_FULL
+        if compressed:
+            header |= HEADER_Z
+
+        return [header] + beats
+
+    # The word address the Peripheral passes to the RAM
+    def _bus_adr(self, adr):
+        return self.wb_adr_to_addr(adr) >> self.wb_shift
+
+    def _write_fast(self, adr, data, sel):
+        (_, length) = self._data_length(data, self._compress)
+
+        if self._packed:
+            full = self._header_sel(sel)
+            length += self._packed_length(adr, full) + (full is None)
+        elif self._stream and self.last == (adr, sel, True):
+            length += 1
+        else:
+            length += 2 + self.addr_cycles
+        self.last = (adr, sel, True)
+
+        self.peripheral.adr = self._bus_adr(adr)
+        self.peripheral.sel = sel
+        self.peripheral.bus.write(self.peripheral.adr, data, sel)
+
+        return self._timing(length, 1, True)
+
+    def _read_fast(self, adr, sel):
+        if self._packed:
+            length = self._packed_length(adr, None)
+        elif self._stream and self.last is not None and self.last[0] == adr and not self.last[2]:
+            length = 1
+        else:
+            length = 1 + self.addr_cycles
+        self.last = (adr, sel, False)
+
+        self.peripheral.adr = self._bus_adr(adr)
+        data = self.peripheral.bus.read(self.peripheral.adr)
+        (_, data_length) = self._data_length(data, self.peripheral.compress)
+
+        return (data, self._timing(length, 1 + data_length, False, extra_beats=1))
+
+    def write(self, adr, data, sel=1):
+        if self._fast:
+            return self._write_fast(adr, data, sel)
+
+        if self._compress:
+            (compressed, data_beats) = _encode(data, self.data_cycles, self._bus_width)
+        else:
+            (compressed, data_beats) = (False, _to_beats(data, self.data_cycles, self._bus_width))
+
+        if self._packed:
+            full = self._header_sel(sel)
+            beats = self._packed_header(adr, True, full, compressed)
+            if full is None:
+                beats.append(sel)
+        elif self._stream and self.last == (adr, sel, True):
+            beats = [CmdEnum.WRITE_STREAM_Z if compressed else CmdEnum.WRITE_STREAM]
+        else:
+            beats = [CmdEnum.WRITE_Z if compressed else CmdEnum.WRITE]
+            beats += _to_beats(self.wb_adr_to_addr(adr), self.addr_cycles, self._bus_width)
+            beats.append(sel)
+        beats += data_beats
+        self.last = (adr, sel, True)
+
+        (response, cycles) = self._transact(beats, True)
+        assert(response[0] == CmdEnum.WRITE_ACK)
+
+        return cycles
+
+    def read(self, adr, sel=1):
+        if self._fast:
+            return self._read_fast(adr, sel)
+
+        if self._packed:
+            beats = self._packed_header(adr, False, None, False)
+        elif self._stream and self.last is not None and self.last[0] == adr and not self.last[2]:
+            beats = [CmdEnum.READ_STREAM]
+        else:
+            beats = [CmdEnum.READ]
+            beats += _to_beats(self.wb_adr_to_addr(adr), self.addr_cycles, self._bus_width)
+        self.last = (adr, sel, False)
+
+        # READ_DATA takes one more strobe to notice the last data beat
+        (response, cycles) = self._transact(beats, False, extra_beats=1)
+        assert(response[0] in (CmdEnum.READ_ACK, CmdEnum.READ_ACK_Z))
+
+        return (_decode(response[0] == CmdEnum.READ_ACK_Z, response[1:], self.data_cycles, self._bus_width), cycles)
+
+
+class SystemModel:
+    def __init__(self, addr_width=32, data_width=64, bus_width=8, divisor=1, link_addr_width=32, data=None, init=None, wait_states=0,
+                 pipelined=False, post_writes=False, post_depth=4, stream=False, compress=False,
+                 packed=False, fast=True):
+        self.mem = RAMModel(addr_width=addr_width, data_width=data_width, data=data, init=init, latency=1+wait_states)
+        self.peripheral = PeripheralModel(self.mem, addr_width=link_addr_width, data_width=data_width, bus_width=bus_width,
+                                          pipelined=pipelined, post_writes=post_writes, post_depth=post_depth, compress=compress)
+        self.host = HostModel(self.peripheral, addr_width=link_addr_width, data_width=data_width, bus_width=bus_width, divisor=divisor, stream=stream, compress=compress,
+                              packed=packed, fast=fast)
+
+    def read(self, adr, sel=1):
+        return self.host.read(adr, sel)[0]
+
+    def write(self, adr, data, sel=1):
+        self.host.write(adr, data, sel)
+
+    def idle(self, cycles):
+        self.host.idle(cycles)
+
+    @property
+    def cycles(self):
+        return self.host.cycles
@@ -1,10 +1,11 @@
 import math
 from enum import Enum, unique
-from nmigen import Elaboratable, Module, Signal, Cat
+from nmigen import Elaboratable, Module, Signal, Cat, Mux, Const, Array
+from nmigen.lib.fifo import SyncFIFO
 from nmigen_soc.wishbone import Interface as WishboneInterface
 from nmigen.back import verilog
 
-from cmd import CmdEnum
+from cmd import CmdEnum, HEADER_V1, HEADER_WE, HEADER_ADDR_SHIFT, HEADER_INCR, HEADER_Z, HEADER_FULL, HEADER_WIDE_SHIFT, header_sel_fields, ACK_ERROR
 
 #master: read/write on positive edge
 #slave read/write on negative edge
@@ -22,29 +23,68 @@ class StateEnum(Enum):
     READ_DATA = 7
     READ_ACK = 8
     WRITE_ACK = 9
-
-
+    WRITE_QUEUE = 10
+    WRITE_MASK = 11
+    WRITE_ZDATA = 12
+    READ_MASK = 13
+    READ_ZDATA = 14
+    ECHO = 15
+    ECHO_REPLY = 16
+
+
+# With pipelined=True the downstream Wishbone master uses B4 pipelined mode:
+# stb is dropped as soon as the request is accepted (stb & ~stall) and cyc is
+# held until the outstanding acks come back.
+#
+# With post_writes=True a write is acked on the link as soon as its data has
+# arrived. It waits in a queue of post_depth entries for the downstream bus,
+# and reads are held back until every queued write has completed. A posted
+# write that ends in err sets write_error, which stays set until
+# clear_error is asserted, and sets ACK_ERROR on the next write or read ack
+# so the Host learns about it too.
+#
+# With compress=True zero suppressed write data from the Host is accepted, and
+# read data is sent zero suppressed when that takes fewer beats, see Host.
+#
+# Both the original command framing and packed (v1) headers are accepted.
 class Peripheral(Elaboratable):
-    def __init__(self, addr_width=32, data_width=64, bus_width=8):
+    def __init__(self, addr_width=32, data_width=64, bus_width=8, pipelined=False, post_writes=False, post_depth=4, compress=False):
         if addr_width % bus_width:
             raise ValueError("addr_width={} is not a multiple of bus_width={}".format(addr_width, bus_width))
 
         if data_width % bus_width:
             raise ValueError("data_width={} is not a multiple of bus_width={}".format(data_width, bus_width))
 
+        if post_depth < 1:
+            raise ValueError("post_depth={} must be at least 1".format(post_depth))
+
         #if (clk_divider < 1) (clk_divider & (clk_divider-1) != 0):
             #raise ValueError("clk_divider={} must be a positive power of two".format(clk_divider))
 
         self._addr_width=addr_width
         self._data_width=data_width
         self._bus_width=bus_width
+        self._pipelined=pipelined
+        self._post_writes=post_writes
+        self._post_depth=post_depth
+        self._compress=compress
         #self._clk_divider=clk_divider
 
         self.bus_in = Signal(bus_width)
         self.bus_out = Signal(bus_width)
+        self.parity_out = Signal()
         self.oe = Signal()
 
-        self.wb = WishboneInterface(addr_width=addr_width, data_width=data_width, granularity=8)
+        self.write_error = Signal()
+        self.clear_error = Signal()
+
+        features = []
+        if pipelined:
+            features.append("stall")
+        if post_writes:
+            features.append("err")
+
+        self.wb = WishboneInterface(addr_width=addr_width, data_width=data_width, granularity=8, features=features)
 
     def elaborate(self, platform):
         m = Module()
@@ -57,33 +97,257 @@ class Peripheral(Elaboratable):
         data_r = Signal(self._data_width)
         sel = Signal(self._data_width // 8)
 
-        count = Signal(int(max(math.log2(addr_cycles), math.log2(data_cycles))))
+        count = Signal(range(max(addr_cycles, data_cycles)))
+        # Address beat being received
+        index = Signal(range(addr_cycles+1))
+        # Set when no sel beat follows the address, the access is a full word
+        skip_sel = Signal()
 
         sub_word_bits = int(math.log2(self._data_width//8))
 
+        state = Signal(StateEnum, reset=StateEnum.IDLE)
+
+        # Zero suppression, see Host
+        mask_cycles = -(-data_cycles // self._bus_width)
+        zmask = Signal(mask_cycles*self._bus_width)
+        remaining = zmask[:data_cycles]
+        first = Signal(data_cycles)
+        last_chunk = Signal()
         m.d.comb += [
-            self.wb.adr.eq(addr[sub_word_bits:]),
-            self.wb.dat_w.eq(data_w),
-            self.wb.sel.eq(sel),
+            first.eq(remaining & -remaining),
+            last_chunk.eq((remaining & ~first) == 0),
         ]
 
-        state = Signal(StateEnum, reset=StateEnum.IDLE)
+        # Set for a WRITE_Z command
+        compressed = Signal()
+
+        compress = Signal()
+        nonzero = Signal(data_cycles)
+        if self._compress:
+            m.d.comb += [
+                nonzero.eq(Cat(self.wb.dat_r.word_select(i, self._bus_width).any() for i in range(data_cycles))),
+                compress.eq(mask_cycles + sum(nonzero) < data_cycles),
+            ]
+
+        # The write data once the beat on bus_in has been added
+        data_w_next = Signal(self._data_width)
+        m.d.comb += data_w_next.eq(data_w)
+        with m.If(state == StateEnum.WRITE_DATA):
+            m.d.comb += data_w_next.eq(Cat(data_w[self._bus_width:], self.bus_in))
+        with m.Elif(state == StateEnum.WRITE_ZDATA):
+            for i in range(data_cycles):
+                with m.If(first[i]):
+                    m.d.comb += data_w_next.word_select(i, self._bus_width).eq(self.bus_in)
+
+        # The address and sel of a packed header on bus_in, see Host. The
+        # header replaces the low word address bits of the address held from
+        # the previous command, and a wide one without a sel beat carries the
+        # size and byte lane of the access.
+        header_addr = Signal(self._addr_width)
+        header_sel = Signal.like(sel)
+        header_full = Signal()
 
         m.d.comb += [
-            self.oe.eq((state == StateEnum.READ_DATA) | (state == StateEnum.READ_ACK) | (state == StateEnum.WRITE_ACK)),
-            self.wb.stb.eq((state == StateEnum.WRITE_WB) | (state == StateEnum.READ_WB)),
-            self.wb.cyc.eq((state == StateEnum.WRITE_WB) | (state == StateEnum.READ_WB)),
-            self.wb.we.eq(state == StateEnum.WRITE_WB),
+            header_addr.eq(Mux(self.bus_in & HEADER_INCR, addr + self._data_width//8, addr)),
+            header_full.eq((self.bus_in & HEADER_WE).bool() & (self.bus_in & HEADER_FULL).bool()),
+            header_sel.eq(-1),
         ]
 
+        (size_bits, lane_bits) = header_sel_fields(self._data_width)
+        if self._bus_width > 8 and size_bits + lane_bits <= self._bus_width - 8:
+            fields = self.bus_in[HEADER_WIDE_SHIFT:]
+            low_bits = max(0, min(self._bus_width - 8, self._addr_width - sub_word_bits))
+            low_bits_sel = max(0, min(self._bus_width - 8 - size_bits - lane_bits, self._addr_width - sub_word_bits))
+
+            with m.If(header_full):
+                size = fields[:size_bits]
+                lane = fields[size_bits:size_bits+lane_bits]
+                runs = Array(Const(2**(2**i) - 1, len(sel)) for i in range(2**size_bits))
+                m.d.comb += [
+                    header_addr[sub_word_bits:sub_word_bits+low_bits_sel].eq(fields[size_bits+lane_bits:]),
+                    header_sel.eq(runs[size] << lane),
+                ]
+            with m.Else():
+                m.d.comb += header_addr[sub_word_bits:sub_word_bits+low_bits].eq(fields)
+
+        m.d.comb += self.parity_out.eq(self.bus_out.xor())
+
+        m.d.comb += self.oe.eq((state == StateEnum.READ_DATA) | (state == StateEnum.READ_ACK) | (state == StateEnum.WRITE_ACK) |
+                               (state == StateEnum.READ_MASK) | (state == StateEnum.READ_ZDATA) | (state == StateEnum.ECHO_REPLY))
+
+        # Set when the downstream read for the current command has completed
+        read_done = Signal()
+
+        if self._post_writes:
+            # A posted write has failed and no ack has reported it yet, acked
+            # is set while an ack goes out
+            error_pending = Signal()
+            acked = Signal()
+
+            adr_width = self._addr_width - sub_word_bits
+            m.submodules.queue = queue = SyncFIFO(width=adr_width + self._data_width + len(sel), depth=self._post_depth)
+
+            # The last data beat is still on bus_in
+            m.d.comb += queue.w_data.eq(Cat(addr[sub_word_bits:], data_w_next, sel))
+
+            head_adr = queue.r_data[:adr_width]
+            head_data = queue.r_data[adr_width:adr_width + self._data_width]
+            head_sel = queue.r_data[adr_width + self._data_width:]
+
+            with m.If(queue.r_rdy):
+                m.d.comb += [
+                    self.wb.adr.eq(head_adr),
+                    self.wb.dat_w.eq(head_data),
+                    self.wb.sel.eq(head_sel),
+                    self.wb.we.eq(1),
+                ]
+            with m.Else():
+                m.d.comb += [
+                    self.wb.adr.eq(addr[sub_word_bits:]),
+                    self.wb.sel.eq(sel),
+                ]
+
+            done = Signal()
+            m.d.comb += done.eq(self.wb.ack | self.wb.err)
+
+            # Reads wait until every posted write has been issued and acked
+            drained = Signal()
+            read_issue = Signal()
+            write_done = Signal()
+
+            if self._pipelined:
+                outstanding = Signal(range(self._post_depth + 2))
+                read_issued = Signal()
+
+                accepted = Signal()
+                m.d.comb += [
+                    drained.eq((queue.level == 0) & (outstanding == 0)),
+                    read_issue.eq((state == StateEnum.READ_WB) & drained & ~read_issued),
+
+                    self.wb.stb.eq(queue.r_rdy | read_issue),
+                    self.wb.cyc.eq(self.wb.stb | (outstanding != 0)),
+                    accepted.eq(self.wb.stb & ~self.wb.stall),
+                    queue.r_en.eq(queue.r_rdy & accepted),
+
+                    read_done.eq((read_issued | (read_issue & accepted)) & done),
+                    write_done.eq(done & ~read_done),
+                ]
+
+                m.d.sync += outstanding.eq(outstanding + accepted - done)
+
+                with m.If(read_done):
+                    m.d.sync += read_issued.eq(0)
+                with m.Elif(read_issue & accepted):
+                    m.d.sync += read_issued.eq(1)
+            else:
+                m.d.comb += [
+                    drained.eq(queue.level == 0),
+                    read_issue.eq((state == StateEnum.READ_WB) & drained),
+
+                    self.wb.stb.eq(queue.r_rdy | read_issue),
+                    self.wb.cyc.eq(self.wb.stb),
+                    queue.r_en.eq(queue.r_rdy & done),
+
+                    read_done.eq(read_issue & done),
+                    write_done.eq(queue.r_rdy & done),
+                ]
+
+            with m.If(self.clear_error):
+                m.d.sync += self.write_error.eq(0)
+            with m.Elif(write_done & self.wb.err):
+                m.d.sync += self.write_error.eq(1)
+
+            with m.If(write_done & self.wb.err):
+                m.d.sync += error_pending.eq(1)
+            with m.Elif(acked):
+                m.d.sync += error_pending.eq(0)
+
+        else:
+            m.d.comb += [
+                self.wb.adr.eq(addr[sub_word_bits:]),
+                self.wb.dat_w.eq(data_w),
+                self.wb.sel.eq(sel),
+            ]
+
+            in_wb = Signal()
+
+            m.d.comb += [
+                in_wb.eq((state == StateEnum.WRITE_WB) | (state == StateEnum.READ_WB)),
+                self.wb.cyc.eq(in_wb),
+                self.wb.we.eq(state == StateEnum.WRITE_WB),
+                read_done.eq((state == StateEnum.READ_WB) & self.wb.ack),
+            ]
+
+            if self._pipelined:
+                # Set once the request has been accepted and we are waiting for ack
+                outstanding = Signal()
+
+                m.d.comb += self.wb.stb.eq(in_wb & ~outstanding)
+
+                with m.If(self.wb.ack):
+                    m.d.sync += outstanding.eq(0)
+                with m.Elif(self.wb.stb & ~self.wb.stall):
+                    m.d.sync += outstanding.eq(1)
+            else:
+                m.d.comb += self.wb.stb.eq(in_wb)
+
         m.d.sync += self.bus_out.eq(0)
 
+        def start_write_data(compressed):
+            m.d.sync += data_w.eq(0)
+            with m.If(compressed):
+                m.d.sync += [
+                    count.eq(mask_cycles-1),
+                    state.eq(StateEnum.WRITE_MASK),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    count.eq(data_cycles-1),
+                    state.eq(StateEnum.WRITE_DATA),
+                ]
+
+        # The last beat has been sent. Go through READ_DATA, which drives one
+        # more (zero) beat with oe set before returning to IDLE.
+        def finish_read():
+            m.d.sync += [
+                data_r.eq(0),
+                count.eq(0),
+
+                state.eq(StateEnum.READ_DATA),
+            ]
+
+        # A write or read ack, flagged if a posted write has failed since the
+        # last flagged one
+        def ack(cmd):
+            if not self._post_writes:
+                return cmd
+            m.d.comb += acked.eq(1)
+            return cmd | Mux(error_pending, ACK_ERROR, 0)
+
+        # All the write data has arrived
+        def write_complete():
+            if self._post_writes:
+                with m.If(queue.w_rdy):
+                    m.d.comb += queue.w_en.eq(1)
+                    m.d.sync += [
+                        self.bus_out.eq(ack(CmdEnum.WRITE_ACK)),
+
+                        state.eq(StateEnum.WRITE_ACK),
+                    ]
+                with m.Else():
+                    m.d.sync += state.eq(StateEnum.WRITE_QUEUE)
+            else:
+                m.d.sync += state.eq(StateEnum.WRITE_WB)
+
         with m.Switch(state):
             with m.Case(StateEnum.IDLE):
                 with m.If(self.bus_in == CmdEnum.WRITE):
                     m.d.sync += [
                         addr.eq(0),
+                        index.eq(0),
                         count.eq(addr_cycles-1),
+                        skip_sel.eq(0),
+                        compressed.eq(0),
 
                         state.eq(StateEnum.WRITE_ADDR),
                     ]
@@ -91,45 +355,132 @@ class Peripheral(Elaboratable):
                 with m.Elif(self.bus_in == CmdEnum.READ):
                     m.d.sync += [
                         addr.eq(0),
+                        index.eq(0),
                         count.eq(addr_cycles-1),
 
                         state.eq(StateEnum.READ_ADDR),
                     ]
 
+                # addr and sel are left from the previous command
+                with m.Elif(self.bus_in == CmdEnum.WRITE_STREAM):
+                    start_write_data(0)
+
+                with m.Elif(self.bus_in == CmdEnum.READ_STREAM):
+                    m.d.sync += state.eq(StateEnum.READ_WB)
+
+                # Link calibration, see Host
+                with m.Elif(self.bus_in == CmdEnum.ECHO):
+                    m.d.sync += state.eq(StateEnum.ECHO)
+
+                if self._compress:
+                    with m.Elif(self.bus_in == CmdEnum.WRITE_Z):
+                        m.d.sync += [
+                            addr.eq(0),
+                            index.eq(0),
+                            count.eq(addr_cycles-1),
+                            skip_sel.eq(0),
+                            compressed.eq(1),
+
+                            state.eq(StateEnum.WRITE_ADDR),
+                        ]
+
+                    with m.Elif(self.bus_in == CmdEnum.WRITE_STREAM_Z):
+                        start_write_data(1)
+
+                # Packed header. Address beats replace the low beats of the
+                # previous address.
+                with m.Elif((self.bus_in & HEADER_V1).bool() & ((self.bus_in & (HEADER_WE | HEADER_Z)) != HEADER_Z)):
+                    addr_beats = self.bus_in[HEADER_ADDR_SHIFT:HEADER_ADDR_SHIFT+3]
+                    we = (self.bus_in & HEADER_WE).bool()
+                    z = (self.bus_in & HEADER_Z).bool() if self._compress else 0
+
+                    m.d.sync += [
+                        addr.eq(header_addr),
+                        index.eq(0),
+                        count.eq(addr_beats - 1),
+                        skip_sel.eq(header_full),
+                        compressed.eq(z),
+                    ]
+
+                    with m.If(header_full):
+                        m.d.sync += sel.eq(header_sel)
+
+                    with m.If(we & (addr_beats != 0)):
+                        m.d.sync += state.eq(StateEnum.WRITE_ADDR)
+                    with m.Elif(header_full):
+                        start_write_data(z)
+                    with m.Elif(we):
+                        m.d.sync += state.eq(StateEnum.WRITE_SEL)
+                    with m.Elif(addr_beats != 0):
+                        m.d.sync += state.eq(StateEnum.READ_ADDR)
+                    with m.Else():
+                        m.d.sync += state.eq(StateEnum.READ_WB)
+
             with m.Case(StateEnum.WRITE_ADDR):
-                m.d.sync += addr.eq(Cat(addr[self._bus_width:], self.bus_in)),
+                m.d.sync += [
+                    addr.word_select(index, self._bus_width).eq(self.bus_in),
+                    index.eq(index + 1),
+                ]
                 with m.If(count):
                     m.d.sync += count.eq(count - 1),
+                with m.Elif(skip_sel):
+                    start_write_data(compressed)
                 with m.Else():
                     m.d.sync += state.eq(StateEnum.WRITE_SEL)
 
             with m.Case(StateEnum.READ_ADDR):
-                m.d.sync += addr.eq(Cat(addr[self._bus_width:], self.bus_in)),
+                m.d.sync += [
+                    addr.word_select(index, self._bus_width).eq(self.bus_in),
+                    index.eq(index + 1),
+                ]
                 with m.If(count):
                     m.d.sync += count.eq(count - 1)
                 with m.Else():
                     m.d.sync += state.eq(StateEnum.READ_WB)
 
             with m.Case(StateEnum.WRITE_SEL):
-                m.d.sync += [
-                    sel.eq(self.bus_in),
-                    data_w.eq(0),
-                    count.eq(data_cycles-1),
-
-                    state.eq(StateEnum.WRITE_DATA),
-                ]
+                m.d.sync += sel.eq(self.bus_in)
+                start_write_data(compressed)
 
             with m.Case(StateEnum.WRITE_DATA):
-                m.d.sync += data_w.eq(Cat(data_w[self._bus_width:], self.bus_in)),
+                m.d.sync += data_w.eq(data_w_next)
                 with m.If(count):
                     m.d.sync += count.eq(count - 1)
                 with m.Else():
-                    m.d.sync += state.eq(StateEnum.WRITE_WB)
+                    write_complete()
+
+            with m.Case(StateEnum.WRITE_MASK):
+                m.d.sync += zmask.eq(Cat(zmask[self._bus_width:], self.bus_in))
+                with m.If(count):
+                    m.d.sync += count.eq(count - 1)
+                with m.Elif(Cat(zmask[self._bus_width:], self.bus_in)[:data_cycles] == 0):
+                    # All zero, no data beats follow
+                    write_complete()
+                with m.Else():
+                    m.d.sync += state.eq(StateEnum.WRITE_ZDATA)
+
+            with m.Case(StateEnum.WRITE_ZDATA):
+                m.d.sync += [
+                    data_w.eq(data_w_next),
+                    zmask.eq(zmask & ~first),
+                ]
+                with m.If(last_chunk):
+                    write_complete()
+
+            with m.Case(StateEnum.WRITE_QUEUE):
+                if self._post_writes:
+                    with m.If(queue.w_rdy):
+                        m.d.comb += queue.w_en.eq(1)
+                        m.d.sync += [
+                            self.bus_out.eq(ack(CmdEnum.WRITE_ACK)),
+
+                            state.eq(StateEnum.WRITE_ACK),
+                        ]
 
             with m.Case(StateEnum.WRITE_WB):
                 with m.If(self.wb.ack == 1):
                     m.d.sync += [
-                        self.bus_out.eq(CmdEnum.WRITE_ACK),
+                        self.bus_out.eq(ack(CmdEnum.WRITE_ACK)),
 
                         state.eq(StateEnum.WRITE_ACK),
                     ]
@@ -138,14 +489,56 @@ class Peripheral(Elaboratable):
                 m.d.sync += state.eq(StateEnum.IDLE)
 
             with m.Case(StateEnum.READ_WB):
-                with m.If(self.wb.ack == 1):
+                with m.If(read_done & compress):
+                    m.d.sync += [
+                        self.bus_out.eq(ack(CmdEnum.READ_ACK_Z)),
+                        data_r.eq(self.wb.dat_r),
+                        zmask.eq(nonzero),
+                        count.eq(mask_cycles-1),
+
+                        state.eq(StateEnum.READ_MASK),
+                    ]
+                with m.Elif(read_done):
                     m.d.sync += [
-                        self.bus_out.eq(CmdEnum.READ_ACK),
+                        self.bus_out.eq(ack(CmdEnum.READ_ACK)),
                         data_r.eq(self.wb.dat_r),
 
                         state.eq(StateEnum.READ_ACK),
                     ]
 
+            # zmask rotates so it is back in place after the mask beats
+            with m.Case(StateEnum.READ_MASK):
+                m.d.sync += [
+                    self.bus_out.eq(zmask[:self._bus_width]),
+                    zmask.eq(zmask.rotate_right(self._bus_width)),
+                ]
+                with m.If(count):
+                    m.d.sync += count.eq(count - 1)
+                with m.Elif(remaining == 0):
+                    finish_read()
+                with m.Else():
+                    m.d.sync += state.eq(StateEnum.READ_ZDATA)
+
+            with m.Case(StateEnum.READ_ZDATA):
+                for i in range(data_cycles):
+                    with m.If(first[i]):
+                        m.d.sync += self.bus_out.eq(data_r.word_select(i, self._bus_width))
+                m.d.sync += zmask.eq(zmask & ~first)
+                with m.If(last_chunk):
+                    finish_read()
+
+            with m.Case(StateEnum.ECHO):
+                m.d.sync += [
+                    self.bus_out.eq(CmdEnum.ECHO_ACK),
+                    data_r.eq(self.bus_in),
+
+                    state.eq(StateEnum.ECHO_REPLY),
+                ]
+
+            with m.Case(StateEnum.ECHO_REPLY):
+                m.d.sync += self.bus_out.eq(data_r[:self._bus_width])
+                finish_read()
+
             with m.Case(StateEnum.READ_ACK):
                 m.d.sync += [
                     self.bus_out.eq(data_r[:self._bus_width]),
@@ -171,4 +564,5 @@ class Peripheral(Elaboratable):
 if __name__ == "__main__":
     top = Peripheral(addr_width=32, data_width=64, bus_width=8)
     with open("peripheral.v", "w") as f:
-        f.write(verilog.convert(top, ports=[top.bus_in, top.bus_out, top.oe, top.wb.adr, top.wb.dat_w, top.wb.dat_r, top.wb.sel, top.wb.cyc, top.wb.stb, top.wb.we, top.wb.ack], name="peripheral_top", strip_internal_attrs=True))
+        f.write(verilog.convert(top, ports=[top.bus_in, top.bus_out, top.parity_out, top.oe, top.wb.adr, top.wb.dat_w, top.wb.dat_r, top.wb.sel, top.wb.cyc, top.wb.stb, top.wb.we, top.wb.ack,
+                                             top.write_error, top.clear_error], name="peripheral_top", strip_internal_attrs=True))
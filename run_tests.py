@@ -0,0 +1,90 @@
+# Runs the unittest suite across a pool of processes
+#
+# Tests are discovered the way "python -m unittest" finds them and each one
+# is run in a worker on its own, so the configuration matrix in
+# test_system.py spreads across every core. Waveforms are controlled by
+# SIMBUS_VCD (see helpers.run_simulation()), which --vcd sets for the workers.
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+
+from helpers import VCD_MODES
+
+
+# Test ids under start, filtered to those containing one of the patterns
+def discover(start, patterns):
+    ids = []
+
+    def walk(suite):
+        for test in suite:
+            if isinstance(test, unittest.TestSuite):
+                walk(test)
+            else:
+                ids.append(test.id())
+
+    walk(unittest.defaultTestLoader.discover(start))
+
+    if patterns:
+        ids = [i for i in ids if any(p in i for p in patterns)]
+
+    return ids
+
+
+def run(test_id):
+    result = unittest.TestResult()
+    start = time.time()
+    unittest.defaultTestLoader.loadTestsFromName(test_id).run(result)
+    failures = [tb for (_, tb) in result.errors + result.failures]
+
+    return (test_id, failures, len(result.skipped), time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the tests in parallel")
+    parser.add_argument("patterns", nargs="*", help="only run tests whose id contains one of these")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes (default: one per core)")
+    parser.add_argument("--vcd", choices=VCD_MODES, help="write waveforms on failure, for all tests or never")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print each test and its run time")
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.vcd:
+        os.environ["SIMBUS_VCD"] = args.vcd
+
+    start = time.time()
+    ids = discover(os.path.dirname(os.path.abspath(__file__)), args.patterns)
+
+    failed = []
+    skipped = 0
+    with multiprocessing.Pool(args.jobs) as pool:
+        for (test_id, failures, n_skipped, elapsed) in pool.imap_unordered(run, ids):
+            skipped += n_skipped
+            if failures:
+                failed.append((test_id, failures))
+
+            if args.verbose:
+                print("{} ... {} ({:.1f}s)".format(test_id, "FAIL" if failures else "ok", elapsed))
+            else:
+                print("F" if failures else ".", end="", flush=True)
+
+    if not args.verbose:
+        print()
+
+    for (test_id, failures) in failed:
+        for tb in failures:
+            print("=" * 70)
+            print("FAIL: {}".format(test_id))
+            print("-" * 70)
+            print(tb)
+
+    print("Ran {} tests in {:.1f}s with {} jobs".format(len(ids), time.time() - start, args.jobs))
+    print("FAILED (failures={})".format(len(failed)) if failed else "OK" + (" (skipped={})".format(skipped) if skipped else ""))
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,229 @@
+# Synthesis resource and timing sweep for Host, Peripheral and RAM
+#
+# Each module is elaborated for every point of a parameter grid, widths and
+# the feature options in FEATURES, and run through yosys. If nextpnr for the target is installed the design is also
+# placed and routed to get an fmax estimate. Results are cached by a hash of
+# the parameters, target and source files so reruns only synthesise what
+# changed.
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from nmigen.back import rtlil
+
+from host import Host
+from peripheral import Peripheral
+from RAM import RAM
+
+
+def host_top(addr_width, data_width, bus_width, stream=False, compress=False, packed=False, calibrate=False):
+    top = Host(addr_width=addr_width, data_width=data_width, bus_width=bus_width, stream=stream, compress=compress, packed=packed,
+               calibrate=calibrate)
+    ports = [top.bus_in, top.parity_in, top.bus_out, top.parity_out, top.oe, top.clk_out,
+             top.start_calibration, top.calibrating, top.calibrated, top.calibration_failed, top.divisor,
+             top.write_error, top.clear_error]
+    return (top, ports + [top.wb[f] for f in top.wb.fields])
+
+
+def peripheral_top(addr_width, data_width, bus_width, pipelined=False, post_writes=False, post_depth=4, compress=False):
+    top = Peripheral(addr_width=addr_width, data_width=data_width, bus_width=bus_width, pipelined=pipelined,
+                     post_writes=post_writes, post_depth=post_depth, compress=compress)
+    ports = [top.bus_in, top.bus_out, top.parity_out, top.oe, top.write_error, top.clear_error]
+    return (top, ports + [top.wb[f] for f in top.wb.fields])
+
+
+def ram_top(mem_addr_width, data_width, pipelined=False, latency=1):
+    top = RAM(addr_width=mem_addr_width, data_width=data_width, pipelined=pipelined, latency=latency)
+    return (top, [top[f] for f in top.fields])
+
+
+MODULES = {
+    "host": (host_top, ["host.py", "cmd.py"]),
+    "peripheral": (peripheral_top, ["peripheral.py", "cmd.py"]),
+    "ram": (ram_top, ["RAM.py"]),
+}
+
+TARGETS = {
+    # yosys synth command, nextpnr binary and arguments
+    "ice40": ("synth_ice40", "nextpnr-ice40", ["--up5k", "--package", "sg48", "--pcf-allow-unconstrained"]),
+    "ecp5": ("synth_ecp5", "nextpnr-ecp5", ["--25k", "--package", "CABGA256"]),
+}
+
+# Cell name prefixes counted as each resource
+RESOURCES = {
+    "ice40": {"lut": ["SB_LUT4"], "ff": ["SB_DFF"], "bram": ["SB_RAM40_4K"]},
+    "ecp5": {"lut": ["LUT4"], "ff": ["TRELLIS_FF"], "bram": ["DP16KD", "PDPW16KD"]},
+}
+
+FIELDS = ["module", "params", "target", "lut", "ff", "bram", "fmax_mhz"]
+
+
+def cache_key(module, params, target):
+    h = hashlib.sha256()
+    h.update(json.dumps([module, params, target], sort_keys=True).encode())
+    for filename in MODULES[module][1]:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def count_cells(cells, target):
+    result = dict()
+    for (resource, prefixes) in RESOURCES[target].items():
+        result[resource] = sum(n for (cell, n) in cells.items() if any(cell.startswith(p) for p in prefixes))
+    return result
+
+
+def synthesise(module, params, target, workdir):
+    (top, ports) = MODULES[module][0](**params)
+    (synth_cmd, nextpnr, nextpnr_args) = TARGETS[target]
+
+    il = os.path.join(workdir, "top.il")
+    netlist = os.path.join(workdir, "top.json")
+    stat = os.path.join(workdir, "stat.json")
+
+    with open(il, "w") as f:
+        f.write(rtlil.convert(top, ports=ports, name="top"))
+
+    script = "read_rtlil {}; {} -top top -json {}; tee -q -o {} stat -json".format(il, synth_cmd, netlist, stat)
+    subprocess.run(["yosys", "-q", "-p", script], check=True, cwd=workdir)
+
+    with open(stat) as f:
+        cells = json.load(f)["modules"]["\\top"]["cells_by_type"]
+
+    result = count_cells(cells, target)
+    result["fmax_mhz"] = None
+
+    if shutil.which(nextpnr):
+        p = subprocess.run([nextpnr, "--json", netlist] + nextpnr_args, cwd=workdir,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        found = re.findall(r"Max frequency for clock '[^']*': ([0-9.]+) MHz", p.stdout)
+        if found:
+            # The last report is the post-route one
+            result["fmax_mhz"] = float(found[-1])
+
+    return result
+
+
+def run(module, params, target, cache_dir):
+    filename = os.path.join(cache_dir, "{}.json".format(cache_key(module, params, target)))
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        result = synthesise(module, params, target, workdir)
+
+    result = dict(module=module, params=params, target=target, **result)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(result, f)
+
+    return result
+
+
+# Feature axes swept for each module, on top of the widths. A post_depth of 0
+# means writes are not posted.
+FEATURES = {
+    "host": ["stream", "compress", "packed", "calibrate"],
+    "peripheral": ["pipelined", "post_depth", "compress"],
+    "ram": ["pipelined", "latency"],
+}
+
+
+def feature_params(name, value):
+    if name == "post_depth":
+        return dict(post_writes=True, post_depth=value) if value else dict(post_writes=False)
+    if name == "latency":
+        return dict(latency=value)
+    return {name: bool(value)}
+
+
+def grid(module, addr_widths, data_widths, bus_widths, mem_addr_widths, features=None):
+    if module == "ram":
+        widths = [dict(mem_addr_width=mem_addr_width, data_width=data_width)
+                  for (mem_addr_width, data_width) in itertools.product(mem_addr_widths, data_widths)]
+    else:
+        widths = [dict(addr_width=addr_width, data_width=data_width, bus_width=bus_width)
+                  for (addr_width, data_width, bus_width) in itertools.product(addr_widths, data_widths, bus_widths)
+                  if not (addr_width % bus_width or data_width % bus_width)]
+
+    names = FEATURES[module]
+    for params in widths:
+        for values in itertools.product(*((features or {}).get(name, [0]) for name in names)):
+            params = dict(params)
+            for (name, value) in zip(names, values):
+                params.update(feature_params(name, value))
+
+            # Skip combinations the module does not support, eg packed
+            # headers on a narrow link
+            try:
+                MODULES[module][0](**params)
+            except ValueError:
+                continue
+            yield params
+
+
+def format_params(params):
+    return " ".join("{}={}".format(k, v) for (k, v) in params.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthesise Host, Peripheral and RAM across a parameter grid")
+    parser.add_argument("--module", choices=MODULES.keys(), nargs="+", default=list(MODULES.keys()))
+    parser.add_argument("--target", choices=TARGETS.keys(), default="ice40")
+    parser.add_argument("--addr-width", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--data-width", type=int, nargs="+", default=[32, 64])
+    parser.add_argument("--bus-width", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--mem-addr-width", type=int, nargs="+", default=[8, 10])
+    parser.add_argument("--stream", type=int, choices=[0, 1], nargs="+", default=[0])
+    parser.add_argument("--compress", type=int, choices=[0, 1], nargs="+", default=[0])
+    parser.add_argument("--packed", type=int, choices=[0, 1], nargs="+", default=[0])
+    parser.add_argument("--calibrate", type=int, choices=[0, 1], nargs="+", default=[0])
+    parser.add_argument("--pipelined", type=int, choices=[0, 1], nargs="+", default=[0])
+    parser.add_argument("--post-depth", type=int, nargs="+", default=[0], help="0 for no posted writes")
+    parser.add_argument("--latency", type=int, nargs="+", default=[1], help="RAM latency")
+    parser.add_argument("--cache-dir", default=".synth_cache")
+    parser.add_argument("--format", choices=["table", "csv", "json"], default="table")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    args = parser.parse_args()
+
+    if not shutil.which("yosys"):
+        sys.exit("yosys not found in PATH")
+
+    results = []
+    for module in args.module:
+        features = {name: getattr(args, name) for name in FEATURES[module]}
+        for params in grid(module, args.addr_width, args.data_width, args.bus_width, args.mem_addr_width, features):
+            results.append(run(module, params, args.target, args.cache_dir))
+
+    f = open(args.output, "w") if args.output else sys.stdout
+
+    if args.format == "json":
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    else:
+        rows = [dict(r, params=format_params(r["params"])) for r in results]
+        if args.format == "csv":
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            line = "{:<12}{:<" + str(max([45] + [len(r["params"]) + 2 for r in rows])) + "}{:>8}{:>8}{:>8}{:>10}\n"
+            f.write(line.format("module", "params", "LUT", "FF", "BRAM", "fmax"))
+            for r in rows:
+                fmax = "-" if r["fmax_mhz"] is None else "{:.1f}".format(r["fmax_mhz"])
+                f.write(line.format(r["module"], r["params"], r["lut"], r["ff"], r["bram"], fmax))
+
+    if args.output:
+        f.close()
@@ -1,9 +1,8 @@
 import unittest
 
-from nmigen.sim import Simulator
-
 from host import Host
-from cmd import CmdEnum
+from cmd import CmdEnum, ACK_ERROR
+from helpers import run_simulation
 
 
 class TestSum(unittest.TestCase):
@@ -85,11 +84,7 @@ class TestSum(unittest.TestCase):
             self.assertEqual((yield self.dut.wb.stall), 1)
 
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench)
-        with sim.write_vcd("test_host_write.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench)
 
     def test_host_read(self):
         def bench():
@@ -159,12 +154,49 @@ class TestSum(unittest.TestCase):
 #            self.assertEqual((yield self.dut.wb.stall), 1)
 
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench)
-        with sim.write_vcd("test_host_read.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench)
+
+
+
+class TestWriteError(unittest.TestCase):
+    def setUp(self):
+        self.dut = Host()
+
+    def test_write_error(self):
+        def write(ack):
+            yield self.dut.bus_in.eq(ack)
+            yield self.dut.wb.adr.eq(0x48 >> 3)
+            yield self.dut.wb.sel.eq(0xFF)
+            yield self.dut.wb.cyc.eq(1)
+            yield self.dut.wb.stb.eq(1)
+            yield self.dut.wb.we.eq(1)
+            yield
+            while not (yield self.dut.wb.ack):
+                yield
+            yield self.dut.wb.cyc.eq(0)
+            yield self.dut.wb.stb.eq(0)
+            yield self.dut.bus_in.eq(0)
+            yield
+
+        def bench():
+            yield from write(CmdEnum.WRITE_ACK)
+            self.assertEqual((yield self.dut.write_error), 0)
+
+            # A flagged ack completes the access and sets write_error
+            yield from write(CmdEnum.WRITE_ACK | ACK_ERROR)
+            self.assertEqual((yield self.dut.write_error), 1)
+
+            # Sticky until cleared
+            yield from write(CmdEnum.WRITE_ACK)
+            self.assertEqual((yield self.dut.write_error), 1)
+
+            yield self.dut.clear_error.eq(1)
+            yield
+            yield self.dut.clear_error.eq(0)
+            yield
+            self.assertEqual((yield self.dut.write_error), 0)
 
+        run_simulation(self, self.dut, bench)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+import io
+import unittest
+
+from linktrace import TraceProbe, load, analyze, percentile
+from traffic import TrafficGenerator, Scoreboard, Traffic
+from test_system import System, ram_init
+from helpers import Helpers, run_simulation
+
+
+class Test(unittest.TestCase, Helpers):
+    addr_width=8
+    data_width=64
+    bus_width=8
+    divisor=1
+
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor)
+
+    def test_phases(self):
+        f = io.StringIO()
+        probe = TraceProbe(self.dut.host, self.dut.peripheral, f)
+        timings = []
+
+        def bench():
+            for i in range(4):
+                (_, cycles) = (yield from self.timed(self.wishbone_write(self.dut.wb, i, i, 0x0f)))
+                timings.append(cycles)
+                (_, cycles) = (yield from self.timed(self.wishbone_read(self.dut.wb, i)))
+                timings.append(cycles)
+            for i in range(3):
+                yield
+
+        run_simulation(self, self.dut, bench, probe.process)
+
+        self.assertEqual([r["op"] for r in probe.records], ["write", "read"]*4)
+        self.assertEqual([r["cycles"] for r in probe.records], timings)
+        self.assertEqual([r["gap"] for r in probe.records], [0]*8)
+        self.assertEqual([r["adr"] for r in probe.records[::2]], list(range(4)))
+
+        addr_cycles = 32//self.bus_width
+        data_cycles = self.data_width//self.bus_width
+        for r in probe.records:
+            if r["op"] == "write":
+                # Command, address, sel and data, then the ack
+                self.assertEqual(r["request"], 1 + addr_cycles + 1 + data_cycles)
+                self.assertEqual(r["response"], 1)
+            else:
+                self.assertEqual(r["request"], 1 + addr_cycles)
+                self.assertEqual(r["response"], 1 + data_cycles)
+            # One strobe every divisor cycles, depending on where the access started
+            self.assertIn(r["request"] + r["wait"] + r["response"], (r["cycles"]//self.divisor, -(-r["cycles"]//self.divisor)))
+
+        f.seek(0)
+        (header, records) = load(f)
+        self.assertEqual(header, {"bus_width": self.bus_width, "data_width": self.data_width})
+        self.assertEqual(records, probe.records)
+
+    def test_traffic(self):
+        generator = TrafficGenerator(self.addr_width, self.data_width, seed=4, density=0.5, max_gap=8)
+        traffic = Traffic(self.dut.wb, generator, Scoreboard(self.data_width, init=ram_init), 40)
+        probe = TraceProbe(self.dut.host, self.dut.peripheral)
+
+        run_simulation(self, self.dut, traffic.process, probe.process)
+
+        report = analyze(probe.header, probe.records)
+        self.assertEqual(report["transactions"], 40)
+        self.assertEqual(report["cycles"], traffic.cycles)
+        self.assertEqual(report["idle_cycles"], sum(t.gap for t in generator.transactions(40)))
+        self.assertAlmostEqual(report["payload_efficiency"]*report["link_strobes"]*self.bus_width/8, traffic.payload)
+
+
+class TestDivisor(Test):
+    divisor=3
+
+
+class TestAnalyze(unittest.TestCase):
+    header = {"bus_width": 8, "data_width": 64}
+
+    def record(self, start, op, cycles, request, wait, response, gap, sel=0xff):
+        return {"start": start, "op": op, "adr": 0, "sel": sel, "cycles": cycles,
+                "request": request, "wait": wait, "response": response, "gap": gap}
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 90), 7)
+        self.assertEqual(percentile([], 50), 0)
+
+    def test_report(self):
+        records = [
+            self.record(2, "write", 10, 6, 2, 2, 2),
+            self.record(12, "read", 8, 2, 2, 4, 0, sel=0x0f),
+            self.record(24, "read", 12, 2, 6, 4, 4, sel=0x0f),
+        ]
+        report = analyze(self.header, records)
+
+        self.assertEqual(report["transactions"], 3)
+        self.assertEqual(report["reads"], 2)
+        self.assertEqual(report["cycles"], 36)
+        self.assertEqual(report["link_strobes"], 30)
+        self.assertEqual(report["link_busy"], 20/30)
+        # 8 + 4 + 4 payload bytes over 30 byte wide strobes
+        self.assertEqual(report["payload_efficiency"], 16/30)
+        self.assertEqual(report["idle_cycles"], 6)
+        self.assertEqual(report["back_to_back"], 1/3)
+        self.assertEqual(report["max_gap"], 4)
+        self.assertEqual(report["read_latency_p50"], 8)
+        self.assertEqual(report["read_latency_max"], 12)
+        self.assertEqual(report["read_wait"], 4)
+        self.assertEqual(report["write_request"], 6)
+
+    def test_no_header(self):
+        with self.assertRaises(ValueError):
+            load(io.StringIO('{"start": 0, "op": "read"}\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import random
+import unittest
+
+from model import SystemModel
+from helpers import Helpers, run_simulation
+from test_system import System, ram_init
+
+
+class Test(unittest.TestCase, Helpers):
+    addr_width=8
+    data_width=64
+    bus_width=8
+    divisor=1
+    link_addr_width=32
+    sparse=False
+    wait_states=0
+    pipelined=False
+    post_writes=False
+    post_depth=4
+    stream=False
+    compress=False
+    packed=False
+    # The gateware is checked against the beat level model, TestFast checks
+    # the fast one against that
+    fast=False
+
+    transactions=200
+    seed=42
+
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor, link_addr_width=self.link_addr_width,
+                          sparse=self.sparse, wait_states=self.wait_states, pipelined=self.pipelined,
+                          post_writes=self.post_writes, post_depth=self.post_depth, stream=self.stream,
+                          compress=self.compress, packed=self.packed)
+
+        self.model = SystemModel(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor, link_addr_width=self.link_addr_width,
+                                 init=ram_init, wait_states=self.wait_states,
+                                 pipelined=self.pipelined, post_writes=self.post_writes, post_depth=self.post_depth, stream=self.stream,
+                                 compress=self.compress, packed=self.packed, fast=self.fast)
+
+    # A random access, as (write, adr, sel, data). held is the address the
+    # Peripheral holds.
+    def access(self, rng, i, held):
+        # Repeat the previous address and sel to exercise the stream frames
+        if not self.stream or i == 0 or rng.random() < 0.5:
+            self.adr = rng.randrange(2**self.addr_width)
+            self.sel = rng.randrange(1, 2**(self.data_width//8))
+            # Full words and sequential addresses to exercise the packed
+            # header
+            if self.packed and rng.random() < 0.5:
+                self.sel = 2**(self.data_width//8) - 1
+            elif self.packed and rng.random() < 0.5:
+                # A single byte, half word... that a wide header carries as a
+                # size and lane
+                size = 2**rng.randrange((self.data_width//8).bit_length())
+                self.sel = (2**size - 1) << rng.randrange(self.data_width//8 - size + 1)
+            if self.packed and rng.random() < 0.3:
+                self.adr = ((held >> self.model.host.wb_shift) + 1) % 2**self.addr_width
+
+        if rng.random() < 0.5:
+            # Mostly small values when zero suppressing
+            if self.compress and rng.random() < 0.7:
+                data = rng.getrandbits(rng.randrange(self.data_width))
+            else:
+                data = rng.getrandbits(self.data_width)
+            return (True, self.adr, self.sel, data)
+        return (False, self.adr, self.sel, None)
+
+    def test_random_traffic(self):
+        rng = random.Random(self.seed)
+
+        def bench():
+            for i in range(self.transactions):
+                gap = rng.choice([0, 0, 1, 2, 5])
+                for j in range(gap):
+                    yield
+                self.model.idle(gap)
+
+                (write, adr, sel, data) = self.access(rng, i, self.model.host.held)
+                if write:
+                    (_, got_cycles) = (yield from self.timed(self.wishbone_write(self.dut.wb, adr, data, sel)))
+                    exp_cycles = self.model.host.write(adr, data, sel)
+                else:
+                    (got, got_cycles) = (yield from self.timed(self.wishbone_read(self.dut.wb, adr, sel)))
+                    (exp, exp_cycles) = self.model.host.read(adr, sel)
+                    self.assertEqual(exp, got)
+
+                self.assertEqual(exp_cycles, got_cycles)
+
+        if self.sparse:
+            run_simulation(self, self.dut, bench, self.dut.mem.process)
+        else:
+            run_simulation(self, self.dut, bench)
+
+
+class TestDivisor(Test):
+    divisor=3
+
+
+class TestNarrow(Test):
+    data_width=32
+    bus_width=16
+    divisor=2
+    link_addr_width=16
+
+
+class TestWaitStates(Test):
+    wait_states=2
+
+
+class TestPipelined(Test):
+    divisor=2
+    wait_states=1
+    pipelined=True
+
+
+class TestPosted(Test):
+    wait_states=20
+    post_writes=True
+
+
+class TestPostedShallow(Test):
+    divisor=2
+    wait_states=12
+    post_writes=True
+    post_depth=1
+
+
+class TestPostedPipelined(Test):
+    divisor=3
+    wait_states=20
+    pipelined=True
+    post_writes=True
+    post_depth=2
+
+
+class TestStream(Test):
+    divisor=2
+    stream=True
+
+
+class TestStreamPosted(Test):
+    wait_states=20
+    post_writes=True
+    stream=True
+
+
+class TestCompress(Test):
+    divisor=2
+    compress=True
+
+
+class TestCompressNarrow(TestNarrow):
+    compress=True
+
+
+class TestCompressStreamPosted(Test):
+    wait_states=3
+    post_writes=True
+    stream=True
+    compress=True
+
+
+class TestPacked(Test):
+    divisor=2
+    packed=True
+
+
+class TestPackedNarrow(TestNarrow):
+    packed=True
+
+
+class TestPackedWide(Test):
+    bus_width=32
+    packed=True
+
+
+class TestPackedCompressPosted(Test):
+    wait_states=5
+    post_writes=True
+    compress=True
+    packed=True
+
+
+class TestSparse(Test):
+    addr_width=29
+    divisor=2
+    sparse=True
+    wait_states=2
+
+
+class TestSparseNoWait(Test):
+    sparse=True
+
+
+class TestPackedSparse(TestSparse):
+    packed=True
+
+
+# The fast model against the beat level one, for every configuration above
+class TestFast(unittest.TestCase):
+    transactions=2000
+    seed=7
+
+    def compare(self, config):
+        params = dict(addr_width=config.addr_width, data_width=config.data_width, bus_width=config.bus_width, divisor=config.divisor,
+                      link_addr_width=config.link_addr_width, init=ram_init, wait_states=config.wait_states,
+                      pipelined=config.pipelined, post_writes=config.post_writes, post_depth=config.post_depth, stream=config.stream,
+                      compress=config.compress, packed=config.packed)
+        fast = SystemModel(fast=True, **params)
+        beats = SystemModel(fast=False, **params)
+
+        # access() only needs the widths and features of the config
+        test = config()
+        test.model = beats
+
+        rng = random.Random(self.seed)
+        for i in range(self.transactions):
+            gap = rng.choice([0, 0, 1, 2, 5])
+            fast.idle(gap)
+            beats.idle(gap)
+
+            (write, adr, sel, data) = test.access(rng, i, beats.host.held)
+            if write:
+                self.assertEqual(fast.host.write(adr, data, sel), beats.host.write(adr, data, sel))
+            else:
+                self.assertEqual(fast.host.read(adr, sel), beats.host.read(adr, sel))
+            self.assertEqual(fast.host.held, beats.host.held)
+
+        self.assertEqual((fast.host.beats_out, fast.host.beats_in), (beats.host.beats_out, beats.host.beats_in))
+        self.assertEqual(fast.mem.data, beats.mem.data)
+
+    def test_fast(self):
+        configs = [c for c in globals().values() if isinstance(c, type) and issubclass(c, Test)]
+        for config in configs:
+            with self.subTest(config=config.__name__):
+                self.compare(config)
+
+
+if __name__ == '__main__':
+    unittest.main()
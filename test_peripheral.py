@@ -1,9 +1,12 @@
 import unittest
 
-from nmigen.sim import Simulator
+from nmigen import Elaboratable, Module
+from nmigen.sim import Passive, Settle
 
 from peripheral import Peripheral
-from cmd import CmdEnum
+from RAM import RAM
+from cmd import CmdEnum, ACK_ERROR
+from helpers import Helpers, run_simulation
 
 
 class TestSum(unittest.TestCase):
@@ -63,11 +66,7 @@ class TestSum(unittest.TestCase):
 
             self.assertEqual(data, 0x0123456789ABCDEF)
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench_read)
-        with sim.write_vcd("test_read.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench_read, name="read")
 
         def bench_write():
             yield self.dut.wb.ack.eq(0)
@@ -120,12 +119,280 @@ class TestSum(unittest.TestCase):
 
             yield
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench_write)
-        with sim.write_vcd("test_write.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench_write, name="write")
 
 
+class PeripheralRAM(Elaboratable):
+    def __init__(self, addr_width=32, data_width=64, bus_width=8, mem_addr_width=8, pipelined=False, latency=1, post_writes=False, post_depth=4):
+        self.peripheral = Peripheral(addr_width=addr_width, data_width=data_width, bus_width=bus_width, pipelined=pipelined,
+                                     post_writes=post_writes, post_depth=post_depth)
+        self.mem = RAM(addr_width=mem_addr_width, data_width=data_width, pipelined=pipelined, latency=latency)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.peripheral = self.peripheral
+        m.submodules.mem = self.mem
+
+        m.d.comb += self.peripheral.wb.connect(self.mem)
+
+        return m
+
+
+class TestExternalBus(unittest.TestCase, Helpers):
+    addr_width=32
+    data_width=64
+    bus_width=8
+    pipelined=False
+    latency=1
+    post_writes=False
+    post_depth=4
+
+    def setUp(self):
+        self.dut = PeripheralRAM(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, pipelined=self.pipelined, latency=self.latency,
+                                 post_writes=self.post_writes, post_depth=self.post_depth)
+
+    def test_external_bus(self):
+        def bench():
+            bus_out = self.dut.peripheral.bus_in
+            bus_in = self.dut.peripheral.bus_out
+            widths = dict(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width)
+
+            yield from self.external_bus_write(bus_out, bus_in, 0x48, 0x0123456789ABCDEF, 0xff, **widths)
+            yield from self.external_bus_write(bus_out, bus_in, 0x50, 0x5a, 0x01, **widths)
+
+            self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x48, **widths)), 0x0123456789ABCDEF)
+            self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x50, **widths)), 0x5a)
+
+        run_simulation(self, self.dut, bench)
+
+
+class TestExternalBusPipelined(TestExternalBus):
+    pipelined=True
+    latency=3
+
+    def test_pipelined(self):
+        def bench():
+            bus_out = self.dut.peripheral.bus_in
+            bus_in = self.dut.peripheral.bus_out
+
+            yield from self.external_bus_write(bus_out, bus_in, 0x48, 0x0123456789ABCDEF, 0xff)
+
+        def monitor():
+            # Each request is issued for exactly one cycle, and cyc is held
+            # until its ack
+            wb = self.dut.peripheral.wb
+            requests = 0
+            while requests == 0 or (yield wb.cyc):
+                yield
+                if (yield wb.stb) and not (yield wb.stall):
+                    requests += 1
+                if (yield wb.stb):
+                    self.assertEqual((yield wb.cyc), 1)
+                if (yield wb.ack):
+                    self.assertEqual((yield wb.stb), 0)
+            self.assertEqual(requests, 1)
+
+        run_simulation(self, self.dut, bench, monitor)
+
+
+class TestExternalBusPosted(TestExternalBus):
+    latency=6
+    post_writes=True
+    post_depth=2
+
+    def test_posted(self):
+        acks = []
+
+        def bench():
+            bus_out = self.dut.peripheral.bus_in
+            bus_in = self.dut.peripheral.bus_out
+
+            # Each write is acked on the link before the RAM has seen it
+            for i in range(4):
+                yield from self.external_bus_write(bus_out, bus_in, 0x80 + i*8, i+1, 0xff)
+                self.assertEqual(len(acks), i)
+                while len(acks) <= i:
+                    yield
+
+            # Reads are ordered behind queued writes
+            for i in range(4):
+                yield from self.external_bus_write(bus_out, bus_in, 0x80 + i*8, 0x10+i, 0xff)
+            for i in range(4):
+                self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x80 + i*8)), 0x10+i)
+
+        def monitor():
+            yield Passive()
+            while True:
+                yield
+                if (yield self.dut.peripheral.wb.ack):
+                    acks.append(1)
+
+        run_simulation(self, self.dut, bench, monitor)
+
+
+class TestExternalBusPostedPipelined(TestExternalBusPosted):
+    pipelined=True
+    post_depth=1
+
+
+class TestExternalBusPostedDeep(TestExternalBusPosted):
+    pipelined=True
+    latency=40
+    post_depth=4
+
+    def test_outstanding(self):
+        outstanding = [0]
+
+        def bench():
+            bus_out = self.dut.peripheral.bus_in
+            bus_in = self.dut.peripheral.bus_out
+
+            # The RAM is slower than the link, so queued writes are issued
+            # back to back with several acks outstanding
+            for i in range(8):
+                yield from self.external_bus_write(bus_out, bus_in, 0x80 + i*8, 0x20+i, 0xff)
+            for i in range(8):
+                self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x80 + i*8)), 0x20+i)
+            self.assertGreaterEqual(max(outstanding), 3)
+
+        def monitor():
+            yield Passive()
+            wb = self.dut.peripheral.wb
+            count = 0
+            while True:
+                yield
+                if (yield wb.stb) and not (yield wb.stall):
+                    count += 1
+                if (yield wb.ack):
+                    count -= 1
+                outstanding.append(count)
+
+        run_simulation(self, self.dut, bench, monitor)
+
+
+class TestPostedError(unittest.TestCase, Helpers):
+    pipelined=False
+    post_depth=4
+
+    def setUp(self):
+        self.dut = Peripheral(post_writes=True, pipelined=self.pipelined, post_depth=self.post_depth)
+
+    # Records every ack the Peripheral sends, once
+    def ack_monitor(self, acks):
+        def monitor():
+            yield Passive()
+            last = 0
+            while True:
+                yield
+                val = (yield self.dut.bus_out)
+                if val != last and val & 0x80:
+                    acks.append(val)
+                last = val
+        return monitor
+
+    def test_write_error(self):
+        acks = []
+
+        def bench():
+            bus_out = self.dut.bus_in
+            bus_in = self.dut.bus_out
+
+            yield from self.external_bus_write(bus_out, bus_in, 0x48, 0x5a, 0xff)
+            self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x48)), 0)
+            self.assertEqual((yield self.dut.write_error), 0)
+
+            # Writes to 0x50 fail, which is only reported later, on the
+            # Peripheral and in the next ack
+            yield from self.external_bus_write(bus_out, bus_in, 0x50, 0x5a, 0xff)
+            self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x48)), 0)
+            self.assertEqual((yield self.dut.write_error), 1)
+
+            # Sticky until cleared, but only flagged on one ack
+            yield from self.external_bus_write(bus_out, bus_in, 0x48, 0x5a, 0xff)
+            self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x48)), 0)
+            self.assertEqual((yield self.dut.write_error), 1)
+
+            yield self.dut.clear_error.eq(1)
+            yield
+            yield self.dut.clear_error.eq(0)
+            yield
+            self.assertEqual((yield self.dut.write_error), 0)
+
+            self.assertEqual(acks, [CmdEnum.WRITE_ACK, CmdEnum.READ_ACK, CmdEnum.WRITE_ACK, CmdEnum.READ_ACK | ACK_ERROR,
+                                    CmdEnum.WRITE_ACK, CmdEnum.READ_ACK])
+
+        def slave():
+            yield Passive()
+            wb = self.dut.wb
+            while True:
+                yield wb.ack.eq(0)
+                yield wb.err.eq(0)
+                yield
+                if (yield wb.cyc) and (yield wb.stb):
+                    if (yield wb.we) and (yield wb.adr) == 0x50 >> 3:
+                        yield wb.err.eq(1)
+                    else:
+                        yield wb.ack.eq(1)
+                    yield
+
+        run_simulation(self, self.dut, bench, slave, self.ack_monitor(acks))
+
+
+class TestPostedErrorPipelined(TestPostedError):
+    pipelined=True
+    post_depth=4
+    latency=40
+
+    def test_write_error(self):
+        acks = []
+        mem = {}
+
+        def bench():
+            bus_out = self.dut.bus_in
+            bus_in = self.dut.bus_out
+
+            # Queued behind slow writes, the failing one completes while
+            # later writes are still being sent. The error is flagged on the
+            # first ack after that, once.
+            for i in range(8):
+                yield from self.external_bus_write(bus_out, bus_in, 0x40 + i*8, 0x10+i, 0xff)
+            self.assertEqual(acks[:4], [CmdEnum.WRITE_ACK]*4)
+            self.assertEqual(acks.count(CmdEnum.WRITE_ACK | ACK_ERROR), 1)
+            self.assertEqual((yield self.dut.write_error), 1)
+
+            for i in range(8):
+                self.assertEqual((yield from self.external_bus_read(bus_out, bus_in, 0x40 + i*8)), 0 if i == 2 else 0x10+i)
+            self.assertEqual(acks[8:], [CmdEnum.READ_ACK]*8)
+
+        def slave():
+            yield Passive()
+            wb = self.dut.wb
+            # Requests in flight, with the cycles left until their ack
+            pending = []
+            while True:
+                if pending and pending[0][0] == 0:
+                    adr, we = pending.pop(0)[1:]
+                    yield wb.dat_r.eq(mem.get(adr, 0))
+                    if we and adr == 0x50 >> 3:
+                        yield wb.err.eq(1)
+                    else:
+                        yield wb.ack.eq(1)
+                else:
+                    yield wb.ack.eq(0)
+                    yield wb.err.eq(0)
+                yield
+                yield Settle()
+                for p in pending:
+                    p[0] -= 1
+                if (yield wb.cyc) and (yield wb.stb):
+                    adr = (yield wb.adr)
+                    we = (yield wb.we)
+                    if we and adr != 0x50 >> 3:
+                        mem[adr] = (yield wb.dat_w)
+                    pending.append([self.latency, adr, we])
+
+        run_simulation(self, self.dut, bench, slave, self.ack_monitor(acks))
+
 if __name__ == '__main__':
     unittest.main()
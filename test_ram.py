@@ -0,0 +1,79 @@
+import unittest
+
+from RAM import RAM
+from helpers import Helpers, run_simulation
+
+
+class RAMTest(Helpers):
+    addr_width=6
+    data_width=32
+    pipelined=False
+    latency=1
+
+    burst=8
+
+    def setUp(self):
+        data = [i*0x01010101 for i in range(2**self.addr_width)]
+        self.dut = RAM(addr_width=self.addr_width, data_width=self.data_width, data=data, pipelined=self.pipelined, latency=self.latency)
+
+    def simulate(self, bench):
+        run_simulation(self, self.dut, bench)
+
+
+class Test(RAMTest, unittest.TestCase):
+    def test_classic(self):
+        def bench():
+            for i in range(4):
+                (got, cycles) = (yield from self.timed(self.wishbone_read(self.dut, i)))
+                self.assertEqual(got, i*0x01010101)
+                self.assertEqual(cycles, self.latency + 1)
+
+            yield from self.wishbone_write(self.dut, 3, 0x12345678, 0b0101)
+            self.assertEqual((yield from self.wishbone_read(self.dut, 3)), 0x03340378)
+
+        self.simulate(bench)
+
+
+class TestWaitStates(Test):
+    latency=3
+
+    def test_burst(self):
+        def bench():
+            data = [0x1000 + i for i in range(self.burst)]
+            (_, cycles) = (yield from self.timed(self.wishbone_burst(self.dut, 8, self.burst, data, sel=0xf)))
+
+            # Only the first beat waits
+            self.assertEqual(cycles, self.latency + self.burst)
+
+            (got, cycles) = (yield from self.timed(self.wishbone_burst(self.dut, 7, self.burst + 2)))
+            self.assertEqual(got, [7*0x01010101] + data + [(9+self.burst-1)*0x01010101])
+            self.assertEqual(cycles, self.latency + self.burst + 2)
+
+        self.simulate(bench)
+
+
+class TestPipelined(RAMTest, unittest.TestCase):
+    pipelined=True
+
+    def test_pipelined(self):
+        def bench():
+            writes = [(i, 0xa000 + i, 0xf) for i in range(16, 32)]
+            (_, cycles) = (yield from self.timed(self.wishbone_pipelined(self.dut, writes)))
+
+            # One request per cycle, then wait for the last ack
+            self.assertEqual(cycles, len(writes) + self.latency)
+
+            reads = [(i, None, 0xf) for i in range(14, 34)]
+            (got, cycles) = (yield from self.timed(self.wishbone_pipelined(self.dut, reads)))
+            self.assertEqual(got, [14*0x01010101, 15*0x01010101] + [0xa000 + i for i in range(16, 32)] + [32*0x01010101, 33*0x01010101])
+            self.assertEqual(cycles, len(reads) + self.latency)
+
+        self.simulate(bench)
+
+
+class TestPipelinedLatency(TestPipelined):
+    latency=4
+
+
+if __name__ == '__main__':
+    unittest.main()
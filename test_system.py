@@ -1,46 +1,87 @@
 import random
 import unittest
 
-from nmigen import Elaboratable, Module, Signal, Cat
+from nmigen import Elaboratable, Module, Signal, Cat, EnableInserter
 from nmigen_soc.wishbone import Interface as WishboneInterface
-from nmigen.sim import Simulator
 
-from RAM import RAM
+from RAM import RAM, SparseRAM
 from host import Host
 from peripheral import Peripheral
-from helpers import Helpers
+from helpers import Helpers, run_simulation
+from model import SystemModel
+
+
+# Initial contents of the System RAM
+def ram_init(adr):
+    return hash(adr*0x7382423415232435)
 
 
 class System(Elaboratable):
-    def __init__(self, addr_width=32, data_width=64, bus_width=8, divisor=1):
-        if addr_width % bus_width:
-            raise ValueError("addr_width={} is not a multiple of bus_width={}".format(addr_width, bus_width))
+    # With sparse=True the RAM is replaced by a SparseRAM, whose process must
+    # be run with the testbench: run_simulation(test, system, bench, system.mem.process)
+    # With pipelined=True the Peripheral and RAM use Wishbone B4 pipelined mode.
+    # post_writes and post_depth are passed to the Peripheral, stream,
+    # packed and calibrate to the Host and compress to both.
+    # skew is a list of delays in cycles, one for each link bit and then
+    # parity, applied in both directions.
+    def __init__(self, addr_width=32, data_width=64, bus_width=8, divisor=1, link_addr_width=32, sparse=False, wait_states=0, pipelined=False,
+                 post_writes=False, post_depth=4, stream=False, compress=False,
+                 packed=False, calibrate=False, skew=None):
+        if link_addr_width % bus_width:
+            raise ValueError("link_addr_width={} is not a multiple of bus_width={}".format(link_addr_width, bus_width))
 
         if data_width % bus_width:
             raise ValueError("data_width={} is not a multiple of bus_width={}".format(data_width, bus_width))
 
+        if sparse and pipelined:
+            raise ValueError("SparseRAM does not support pipelined mode")
+
+        if skew is not None and len(skew) != bus_width + 1:
+            raise ValueError("skew needs {} delays, one per link bit and parity".format(bus_width + 1))
+
         self._addr_width=addr_width
         self._data_width=data_width
         self._bus_width=bus_width
         self._divisor=divisor
+        self._link_addr_width=link_addr_width
+        self._sparse=sparse
+        self._skew=skew
 
         self.wb = WishboneInterface(addr_width=addr_width, data_width=data_width, granularity=8, features=["stall"])
 
+        self.host = Host(addr_width=link_addr_width, data_width=data_width, bus_width=bus_width, divisor=divisor, stream=stream, compress=compress,
+                         packed=packed, calibrate=calibrate)
+        self.peripheral = Peripheral(addr_width=link_addr_width, data_width=data_width, bus_width=bus_width, pipelined=pipelined,
+                                     post_writes=post_writes, post_depth=post_depth, compress=compress)
+
+        if sparse:
+            # The peripheral clocks the memory on clk_out
+            self.mem = SparseRAM(addr_width=addr_width, data_width=data_width, init=ram_init, wait_states=wait_states, enable=self.host.clk_out)
+        else:
+            data = [ram_init(i) & (2**data_width - 1) for i in range(2**addr_width)]
+            self.mem = RAM(addr_width=addr_width, data_width=data_width, data=data, pipelined=pipelined, latency=1+wait_states)
+
     def elaborate(self, platform):
         self.m = m = Module()
 
-        m.submodules.host = host = Host()
-        m.submodules.peripheral = peripheral = Peripheral()
+        host = self.host
+        peripheral = self.peripheral
+        mem = self.mem
 
-        data = list()
-        for i in range(2**self._addr_width):
-            data.append(hash(i*0x7382423415232435))
+        m.submodules.host = host
 
-        m.submodules.mem = mem = RAM(addr_width=self._addr_width, data_width=self._data_width, data=data)
+        # The peripheral and its memory are clocked by the link clock
+        m.submodules.peripheral = EnableInserter(host.clk_out)(peripheral)
+        if not self._sparse:
+            m.submodules.mem = EnableInserter(host.clk_out)(mem)
+
+        to_peripheral = self.link(m, Cat(host.bus_out, host.parity_out), "to_peripheral")
+        to_host = self.link(m, Cat(peripheral.bus_out, peripheral.parity_out), "to_host")
 
         m.d.comb += [
-            peripheral.bus_in.eq(host.bus_out),
-            host.bus_in.eq(peripheral.bus_out),
+            peripheral.bus_in.eq(to_peripheral[:self._bus_width]),
+            host.bus_in.eq(to_host[:self._bus_width]),
+            host.parity_in.eq(to_host[-1]),
 
             self.wb.connect(host.wb),
             peripheral.wb.connect(mem),
@@ -49,11 +90,29 @@ class System(Elaboratable):
         return m
 
 
+    # The link wires, delayed by skew
+    def link(self, m, lines, name):
+        if self._skew is None:
+            return lines
+
+        out = []
+        for (i, delay) in enumerate(self._skew):
+            line = lines[i]
+            for j in range(delay):
+                delayed = Signal(name="{}_{}_{}".format(name, i, j))
+                m.d.sync += delayed.eq(line)
+                line = delayed
+            out.append(line)
+
+        return Cat(out)
+
+
 class Test(unittest.TestCase, Helpers):
     addr_width=8
     data_width=64
     bus_width=8
     divisor=1
+    link_addr_width=32
 
     command_delay_cycles=4
 
@@ -61,41 +120,34 @@ class Test(unittest.TestCase, Helpers):
     data_cycles = data_width//bus_width
 
     def setUp(self):
-        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor)
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                          link_addr_width=self.link_addr_width)
 
     def test_read(self):
         def bench():
             for i in range(2**self.addr_width):
-                exp = hash(i*0x7382423415232435)
+                exp = ram_init(i) & (2**self.data_width - 1)
                 got = (yield from self.wishbone_read(self.dut.wb, i))
                 self.assertEqual(exp, got)
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench)
-        with sim.write_vcd("test_system_read.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench)
 
     def test_write(self):
         def bench():
             for i in range(2**self.addr_width):
-                new = hash(2*i*0x7382423415232435)
-                yield from self.wishbone_write(self.dut.wb, i, new, 0xff)
+                new = hash(2*i*0x7382423415232435) & (2**self.data_width - 1)
+                yield from self.wishbone_write(self.dut.wb, i, new, 2**(self.data_width//8) - 1)
 
             for i in range(2**self.addr_width):
-                exp = hash(2*i*0x7382423415232435)
+                exp = hash(2*i*0x7382423415232435) & (2**self.data_width - 1)
                 got = (yield from self.wishbone_read(self.dut.wb, i))
                 self.assertEqual(exp, got)
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench)
-        with sim.write_vcd("test_system.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench)
 
     def test_partial_write(self):
         def bench():
-            for i in range(8):
+            for i in range(self.data_width//8):
                 sel = 2**i
                 # Some sort of changing byte
                 new = (0x5a+i) << (i*8)
@@ -105,11 +157,313 @@ class Test(unittest.TestCase, Helpers):
                 got = (yield from self.wishbone_read(self.dut.wb, i))
                 self.assertEqual(exp, got)
 
-        sim = Simulator(self.dut)
-        sim.add_clock(1e-6)  # 1 MHz
-        sim.add_sync_process(bench)
-        with sim.write_vcd("test_system.vcd"):
-            sim.run()
+        run_simulation(self, self.dut, bench)
+
+
+class TestPosted(Test):
+    post_depth=4
+
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                          link_addr_width=self.link_addr_width, wait_states=3, post_writes=True, post_depth=self.post_depth)
+
+
+class TestPostedShallow(TestPosted):
+    divisor=2
+    post_depth=1
+
+
+class TestStream(Test):
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                          link_addr_width=self.link_addr_width, stream=True)
+
+    def test_fifo(self):
+        def bench():
+            # Push a block of words through one address, the way a device
+            # FIFO register is written. The repeated writes are cheaper.
+            words = [hash(i*0x2342) & (2**self.data_width - 1) for i in range(8)]
+
+            timings = []
+            for w in words:
+                (_, cycles) = (yield from self.timed(self.wishbone_write(self.dut.wb, 0x10, w, 2**(self.data_width//8) - 1)))
+                timings.append(cycles)
+
+            self.assertLess(max(timings[1:]), timings[0])
+
+            timings = []
+            for i in range(4):
+                (got, cycles) = (yield from self.timed(self.wishbone_read(self.dut.wb, 0x10)))
+                self.assertEqual(words[-1], got)
+                timings.append(cycles)
+
+            self.assertLess(max(timings[1:]), timings[0])
+
+            # A different sel needs the full frame
+            yield from self.wishbone_write(self.dut.wb, 0x11, 0x5a, 0x01)
+            yield from self.wishbone_write(self.dut.wb, 0x11, 0xa5 << 8, 0x02)
+            yield from self.wishbone_write(self.dut.wb, 0x11, 0x3c << 8, 0x02)
+            self.assertEqual((yield from self.wishbone_read(self.dut.wb, 0x11)) & 0xffff, 0x3c5a)
+
+        run_simulation(self, self.dut, bench)
+
+
+class TestPacked(Test):
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                          link_addr_width=self.link_addr_width, packed=True)
+
+    def test_fewer_beats(self):
+        rng = random.Random(1)
+        legacy = SystemModel(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                             link_addr_width=self.link_addr_width, init=ram_init)
+
+        def bench():
+            for i in range(64):
+                adr = rng.randrange(2**self.addr_width)
+                full = 2**(self.data_width//8) - 1
+                sel = rng.choice([full, rng.randrange(1, full)])
+                write = rng.random() < 0.5
+                if write:
+                    (_, cycles) = (yield from self.timed(self.wishbone_write(self.dut.wb, adr, i, sel)))
+                    legacy_cycles = legacy.host.write(adr, i, sel)
+                else:
+                    (_, cycles) = (yield from self.timed(self.wishbone_read(self.dut.wb, adr)))
+                    (_, legacy_cycles) = legacy.host.read(adr)
+
+                # At least one beat shorter than the original framing, as
+                # the upper address beats or a full sel can be left out, or
+                # on a wider link the header carries the low address bits
+                # and the sel
+                self.assertLessEqual(cycles, legacy_cycles - self.divisor)
+
+        run_simulation(self, self.dut, bench)
+
+
+class TestPackedDivisor(TestPacked):
+    divisor=3
+
+
+class TestCompress(unittest.TestCase, Helpers):
+    addr_width=8
+    data_width=64
+    bus_width=8
+    divisor=1
+    link_addr_width=32
+
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                          link_addr_width=self.link_addr_width, compress=True)
+
+    def round_trip(self, values):
+        timings = dict()
+
+        def bench():
+            for (i, v) in enumerate(values):
+                (_, write) = (yield from self.timed(self.wishbone_write(self.dut.wb, i, v, 2**(self.data_width//8) - 1)))
+                (got, read) = (yield from self.timed(self.wishbone_read(self.dut.wb, i)))
+                self.assertEqual(v, got)
+                timings[v] = (write, read)
+
+        run_simulation(self, self.dut, bench)
+
+        return timings
+
+    def test_small_values(self):
+        full = 2**self.data_width - 1
+        # Two non-zero beats
+        pair = (1 << self.bus_width) | 1
+        timings = self.round_trip([v & full for v in [0, 1, 0x80, pair, 0xff00ff, 1 << (self.data_width-1), 0x0102030405060708, full]])
+
+        if self.data_width//self.bus_width > 2:
+            # Zero and single beat values need just the mask and that beat,
+            # full words are sent raw
+            self.assertLess(timings[0][0], timings[1][0])
+            self.assertLess(timings[1][1], timings[pair][1])
+            self.assertLess(timings[0xff00ff][0], timings[full][0])
+        self.assertLess(timings[0][1], timings[full][1])
+        self.assertEqual(timings[0x0102030405060708 & full], timings[full])
+
+
+class TestCompressWide(TestCompress):
+    data_width=32
+    bus_width=16
+    divisor=2
+
+
+class TestCalibrate(unittest.TestCase, Helpers):
+    addr_width=8
+    data_width=64
+    bus_width=8
+    divisor=8
+
+    def calibrate(self, skew, expected, start=False):
+        dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                     calibrate=not start, skew=skew)
+        host = dut.host
+
+        def bench():
+            if start:
+                yield
+                self.assertEqual((yield host.calibrating), 0)
+                yield host.start_calibration.eq(1)
+                yield
+                yield host.start_calibration.eq(0)
+                while not (yield host.calibrating):
+                    yield
+
+            self.assertEqual((yield host.calibrating), 1)
+            while not (yield host.calibrated):
+                yield
+
+            self.assertEqual((yield host.calibrating), 0)
+            self.assertEqual((yield host.divisor), expected)
+
+            if expected is None:
+                return
+
+            self.assertEqual((yield host.calibration_failed), 0)
+
+            # The link works at the chosen divisor
+            for i in range(8):
+                yield from self.wishbone_write(dut.wb, i, i*0x0101010101, 0xff)
+            for i in range(8):
+                self.assertEqual(i*0x0101010101, (yield from self.wishbone_read(dut.wb, i)))
+
+        run_simulation(self, dut, bench)
+
+        return dut
+
+    def test_no_skew(self):
+        # Fastest divisor plus the margin
+        self.calibrate(None, 2)
+
+    def test_uniform_delay(self):
+        # A delay every bit sees is just latency
+        self.calibrate([3]*(self.bus_width+1), 2)
+
+    def test_skew(self):
+        self.calibrate([0, 0, 0, 2, 0, 1, 0, 0, 0], 4)
+
+    def test_parity_skew(self):
+        self.calibrate([0]*self.bus_width + [4], 6)
+
+    def test_start(self):
+        self.calibrate([0, 1, 0, 0, 0, 0, 0, 0, 0], 3, start=True)
+
+    # Calibrating at runtime with words in memory. Echo patterns misread at
+    # a divisor that is too fast must not turn into writes, and the accesses
+    # afterwards must not reuse the address the Peripheral held before.
+    def runtime(self, **kwargs):
+        dut = System(addr_width=4, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor,
+                     skew=[0, 3, 3, 0, 1, 0, 0, 0, 0], **kwargs)
+        host = dut.host
+        words = [0x1111111111111111*i for i in range(16)]
+
+        def bench():
+            for (i, w) in enumerate(words):
+                yield from self.wishbone_write(dut.wb, i, w, 0xff)
+
+            yield host.start_calibration.eq(1)
+            yield
+            yield host.start_calibration.eq(0)
+            yield
+            while not (yield host.calibrated):
+                yield
+            self.assertLess((yield host.divisor), self.divisor)
+
+            # The same address and sel as the last write
+            yield from self.wishbone_write(dut.wb, 15, 0x5a, 0xff)
+            words[15] = 0x5a
+
+            for (i, w) in enumerate(words):
+                self.assertEqual(w, (yield from self.wishbone_read(dut.wb, i)))
+
+        run_simulation(self, dut, bench)
+
+    def test_runtime(self):
+        self.runtime()
+
+    def test_runtime_stream(self):
+        self.runtime(stream=True)
+
+    def test_runtime_packed(self):
+        self.runtime(packed=True)
+
+    def test_failed(self):
+        dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=2,
+                     calibrate=True, skew=[0, 5, 0, 0, 0, 0, 0, 0, 0])
+        host = dut.host
+
+        def bench():
+            while not (yield host.calibrated):
+                yield
+            self.assertEqual((yield host.calibration_failed), 1)
+            self.assertEqual((yield host.divisor), 2)
+
+        run_simulation(self, dut, bench)
+
+
+class TestSparse(unittest.TestCase, Helpers):
+    # Full 32 bit link addresses, 64 bit words
+    addr_width=29
+    data_width=64
+    bus_width=8
+    divisor=1
+    wait_states=0
+
+    accesses=64
+
+    def setUp(self):
+        self.dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor, sparse=True, wait_states=self.wait_states)
+
+    def test_write(self):
+        rng = random.Random(0)
+        adrs = [rng.randrange(2**self.addr_width) for i in range(self.accesses)]
+        adrs += [0, 2**self.addr_width-1]
+
+        def bench():
+            for i in adrs:
+                self.assertEqual(ram_init(i), (yield from self.wishbone_read(self.dut.wb, i)))
+
+            for i in adrs:
+                yield from self.wishbone_write(self.dut.wb, i, i*3, 0xff)
+
+            for i in adrs:
+                self.assertEqual(i*3, (yield from self.wishbone_read(self.dut.wb, i)))
+
+        run_simulation(self, self.dut, bench, self.dut.mem.process)
+
+
+class TestSparseWaitStates(TestSparse):
+    divisor=2
+    wait_states=3
+
+
+# Link configurations the system tests are repeated over, as
+# (addr_width, data_width, bus_width, divisor, link_addr_width)
+CONFIGS = [
+    (6, 32, 8, 1, 32),
+    (6, 32, 16, 2, 16),
+    (5, 16, 8, 3, 16),
+    (8, 64, 16, 1, 32),
+    (6, 64, 32, 2, 32),
+    (6, 64, 8, 1, 24),
+]
+
+
+# Adds a subclass of each base for every configuration, such as
+# Test_a6_d32_b8_div1_l32
+def _matrix(*bases):
+    for base in bases:
+        for (addr_width, data_width, bus_width, divisor, link_addr_width) in CONFIGS:
+            name = "{}_a{}_d{}_b{}_div{}_l{}".format(base.__name__, addr_width, data_width, bus_width, divisor, link_addr_width)
+            globals()[name] = type(name, (base,), dict(addr_width=addr_width, data_width=data_width, bus_width=bus_width, divisor=divisor,
+                                                       link_addr_width=link_addr_width))
+
+
+_matrix(Test, TestStream, TestPacked, TestCompress)
+
 
 if __name__ == '__main__':
     unittest.main()
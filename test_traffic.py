@@ -0,0 +1,50 @@
+import unittest
+
+from traffic import TrafficGenerator, Scoreboard, Traffic
+from test_system import System, ram_init
+from helpers import run_simulation
+
+
+class Test(unittest.TestCase):
+    addr_width=8
+    data_width=64
+    bus_width=8
+    divisor=1
+
+    transactions=300
+
+    def run_traffic(self, seed, **kwargs):
+        dut = System(addr_width=self.addr_width, data_width=self.data_width, bus_width=self.bus_width, divisor=self.divisor)
+
+        generator = TrafficGenerator(self.addr_width, self.data_width, seed=seed, **kwargs)
+        scoreboard = Scoreboard(self.data_width, init=ram_init)
+        traffic = Traffic(dut.wb, generator, scoreboard, self.transactions)
+
+        run_simulation(self, dut, traffic.process)
+
+        return (traffic.report(), scoreboard)
+
+    def test_reproducible(self):
+        a = list(TrafficGenerator(self.addr_width, self.data_width, seed=7).transactions(100))
+        b = list(TrafficGenerator(self.addr_width, self.data_width, seed=7).transactions(100))
+        c = list(TrafficGenerator(self.addr_width, self.data_width, seed=8).transactions(100))
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_back_to_back(self):
+        (report, scoreboard) = self.run_traffic(seed=1, density=1.0)
+        self.assertEqual(scoreboard.mismatches, [])
+        self.assertEqual(report["reads"] + report["writes"], self.transactions)
+
+    def test_sparse(self):
+        # Small address range so reads hit earlier writes
+        (report, scoreboard) = self.run_traffic(seed=2, density=0.3, write_ratio=0.7, adr_range=(16, 32))
+        self.assertEqual(scoreboard.mismatches, [])
+
+
+class TestDivisor(Test):
+    divisor=2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# Constrained random traffic and a reference memory scoreboard
+#
+# TrafficGenerator produces a reproducible stream of Wishbone accesses for a
+# given seed. Traffic drives them into a bus with the Helpers accesses and
+# checks every read against a Scoreboard holding what the memory behind the
+# bus should contain.
+
+import random
+from collections import namedtuple
+
+from helpers import Helpers
+
+
+# gap is the number of idle cycles before the access
+Transaction = namedtuple("Transaction", ["write", "adr", "data", "sel", "gap"])
+
+
+class TrafficGenerator:
+    def __init__(self, addr_width, data_width, seed=0, write_ratio=0.5, partial_ratio=0.25, density=1.0, max_gap=16, adr_range=None):
+        if not 0 <= write_ratio <= 1:
+            raise ValueError("write_ratio={} is not between 0 and 1".format(write_ratio))
+
+        if not 0 <= partial_ratio <= 1:
+            raise ValueError("partial_ratio={} is not between 0 and 1".format(partial_ratio))
+
+        if not 0 <= density <= 1:
+            raise ValueError("density={} is not between 0 and 1".format(density))
+
+        self.addr_width = addr_width
+        self.data_width = data_width
+        self.seed = seed
+        self.write_ratio = write_ratio
+        self.partial_ratio = partial_ratio
+        self.density = density
+        self.max_gap = max_gap
+        self.adr_range = adr_range if adr_range is not None else (0, 2**addr_width)
+
+        self._full_sel = 2**(data_width//8) - 1
+
+    def transactions(self, count):
+        rng = random.Random(self.seed)
+
+        for i in range(count):
+            # density is the chance of an access following the previous one
+            # back to back
+            if rng.random() < self.density:
+                gap = 0
+            else:
+                gap = rng.randint(1, self.max_gap)
+
+            adr = rng.randrange(*self.adr_range)
+
+            if rng.random() < self.partial_ratio:
+                sel = rng.randrange(1, self._full_sel)
+            else:
+                sel = self._full_sel
+
+            if rng.random() < self.write_ratio:
+                yield Transaction(True, adr, rng.getrandbits(self.data_width), sel, gap)
+            else:
+                yield Transaction(False, adr, None, sel, gap)
+
+
+class Scoreboard:
+    def __init__(self, data_width, init=None):
+        self.data_width = data_width
+        self.init = init
+
+        self.data = dict()
+        self.mismatches = []
+        self.reads = 0
+        self.writes = 0
+
+    def expected(self, adr):
+        if adr not in self.data:
+            self.data[adr] = self.init(adr) & (2**self.data_width - 1) if self.init is not None else 0
+        return self.data[adr]
+
+    def write(self, adr, data, sel):
+        mask = 0
+        for i in range(self.data_width//8):
+            if sel & (1 << i):
+                mask |= 0xff << (i*8)
+
+        self.data[adr] = (self.expected(adr) & ~mask) | (data & mask)
+        self.writes += 1
+
+    def read(self, adr, got):
+        exp = self.expected(adr)
+        if got != exp:
+            self.mismatches.append((adr, exp, got))
+        self.reads += 1
+
+
+class Traffic(Helpers):
+    def __init__(self, wb, generator, scoreboard, count):
+        self.wb = wb
+        self.generator = generator
+        self.scoreboard = scoreboard
+        self.count = count
+
+        self.cycles = 0
+        self.busy_cycles = 0
+        self.payload = 0
+
+    # Add with Simulator.add_sync_process()
+    def process(self):
+        for t in self.generator.transactions(self.count):
+            for i in range(t.gap):
+                yield
+            self.cycles += t.gap
+
+            if t.write:
+                (_, cycles) = (yield from self.timed(self.wishbone_write(self.wb, t.adr, t.data, t.sel)))
+                self.scoreboard.write(t.adr, t.data, t.sel)
+            else:
+                (got, cycles) = (yield from self.timed(self.wishbone_read(self.wb, t.adr, t.sel)))
+                self.scoreboard.read(t.adr, got)
+
+            self.cycles += cycles
+            self.busy_cycles += cycles
+            self.payload += bin(t.sel).count("1")
+
+    def report(self):
+        return {
+            "seed": self.generator.seed,
+            "transactions": self.count,
+            "reads": self.scoreboard.reads,
+            "writes": self.scoreboard.writes,
+            "mismatches": len(self.scoreboard.mismatches),
+            "cycles": self.cycles,
+            "cycles_per_access": self.busy_cycles / self.count,
+            "mb_per_s_per_mhz": self.payload / self.cycles,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    from helpers import simulator
+    from linktrace import TraceProbe
+    from test_system import System, ram_init
+
+    parser = argparse.ArgumentParser(description="Run constrained random traffic through System")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--transactions", type=int, default=1000)
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--partial-ratio", type=float, default=0.25)
+    parser.add_argument("--density", type=float, default=1.0)
+    parser.add_argument("--max-gap", type=int, default=16)
+    parser.add_argument("--data-width", type=int, default=64)
+    parser.add_argument("--bus-width", type=int, default=8)
+    parser.add_argument("--divisor", type=int, default=1)
+    parser.add_argument("--trace", help="write a transaction trace here, see linktrace.py")
+    args = parser.parse_args()
+
+    addr_width = 8
+    dut = System(addr_width=addr_width, data_width=args.data_width, bus_width=args.bus_width, divisor=args.divisor)
+
+    generator = TrafficGenerator(addr_width, args.data_width, seed=args.seed, write_ratio=args.write_ratio,
+                                 partial_ratio=args.partial_ratio, density=args.density, max_gap=args.max_gap)
+    scoreboard = Scoreboard(args.data_width, init=ram_init)
+    traffic = Traffic(dut.wb, generator, scoreboard, args.transactions)
+
+    sim = simulator(dut)
+    sim.add_clock(1e-6)  # 1 MHz
+    sim.add_sync_process(traffic.process)
+
+    if args.trace:
+        with open(args.trace, "w") as f:
+            probe = TraceProbe(dut.host, dut.peripheral, f)
+            sim.add_sync_process(probe.process)
+            sim.run()
+    else:
+        sim.run()
+
+    print(json.dumps(traffic.report(), indent=2))
+
+    for (adr, exp, got) in scoreboard.mismatches:
+        print("Mismatch at {:#x}: expected {:#x} got {:#x}".format(adr, exp, got))
+
+    if scoreboard.mismatches:
+        sys.exit(1)